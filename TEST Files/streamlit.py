@@ -1,33 +1,34 @@
+import sys
+from pathlib import Path
+
 import streamlit as st
-import requests
-import time
-import json
+
+# sse_client.py lives in the project root, one level up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from sse_client import SSEClient
+
+# Start the backend first: python main_progress.py
+BACKEND_URL = "http://localhost:8000"
 
 st.title("Basic SSE Example")
 
 if st.button("Start Receiving Events"):
     st.write("Connecting to event stream...")
-    
+
     progress_bar = st.progress(0)
     placeholder = st.empty()
-    
-    # We'll simulate SSE in Streamlit by polling
-    for i in range(30):  # We'll show 30 updates
-        # In a real app, you'd use SSE client libraries
-        # Here we're just simulating by getting the latest count
-        response = requests.get("http://localhost:8000/events", stream=True)
-        
-        # Get the first event
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith("data:"):
-                    data = decoded_line[5:].strip()
-                    placeholder.write(f"Received count: {data}")
-                    progress_bar.progress(i / 30)
-                    break
-        
-        response.close()
-        time.sleep(1)
-    
-    st.write("Finished receiving events.")
\ No newline at end of file
+
+    # One connection for the whole job, read as events arrive (no polling). If it drops,
+    # SSEClient reconnects with backoff and resumes after the last event (Last-Event-ID).
+    with SSEClient(f"{BACKEND_URL}/stream-progress", params={"share": "false"}, max_attempts=5) as stream:
+        for event in stream:
+            data = event.json()
+            if event.event == "progress":
+                placeholder.write(f"Received progress: {data.get('message', '')} ({data.get('percent', 0)}%)")
+                progress_bar.progress(min(int(data.get("percent", 0)), 100))
+            elif event.event in ("complete", "error", "cancelled"):
+                placeholder.write(f"Received {event.event}: {data}")
+                progress_bar.progress(100)
+                break
+
+    st.write("Finished receiving events.")
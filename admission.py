@@ -0,0 +1,193 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import ADMISSION_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    """A request that is turned away right away, with a hint for when to retry."""
+
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code  # 429: this client is over its limits, 503: the server is
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class TokenBucket:
+    """Allows `rate` actions per second on average, and bursts of up to `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+class Ticket:
+    """An admitted stream or job; release() gives its slot back (only once, however often it is called)."""
+
+    __slots__ = ("_release",)
+
+    def __init__(self, release):
+        self._release = release
+
+    def release(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+
+class _Client:
+    __slots__ = ("streams", "jobs", "stream_opens", "job_starts")
+
+    def __init__(self, controller: "AdmissionController", now: float):
+        self.streams = 0
+        self.jobs = 0
+        self.stream_opens = TokenBucket(controller.stream_rate, controller.stream_burst, now)
+        self.job_starts = TokenBucket(controller.job_start_rate, controller.job_start_burst, now)
+
+    @property
+    def idle(self) -> bool:
+        return not self.streams and not self.jobs and self.stream_opens.full and self.job_starts.full
+
+
+class AdmissionController:
+    """
+    Caps what the server takes on, so one misbehaving client cannot slow down everyone else.
+    Streams and job starts are limited globally and per client, both in how many
+    are open (or running) at once and, with token buckets, in how fast new ones
+    come in. Over a limit, a request is rejected at once with Rejected (429 for a
+    client's own limits, 503 when the server is full) instead of waiting in line.
+    Clients are identified by an id, normally their address; state is kept for
+    at most `max_clients` of them, and idle ones are forgotten first.
+    """
+
+    def __init__(self, max_streams: int = 10_000, max_streams_per_client: int = 50,
+                 stream_rate: float = 5.0, stream_burst: float = 20,
+                 max_jobs: int = 100, max_jobs_per_client: int = 5,
+                 job_start_rate: float = 0.5, job_start_burst: float = 5,
+                 max_backlog: int = 100_000, busy_retry_after: float = 5.0,
+                 max_clients: int = 10_000, enabled: bool = True):
+        self.max_streams = max_streams
+        self.max_streams_per_client = max_streams_per_client
+        self.stream_rate = stream_rate
+        self.stream_burst = stream_burst
+        self.max_jobs = max_jobs
+        self.max_jobs_per_client = max_jobs_per_client
+        self.job_start_rate = job_start_rate
+        self.job_start_burst = job_start_burst
+        # Events waiting in subscriber queues (slow sockets) before new jobs are refused
+        self.max_backlog = max_backlog
+        # Retry-After for caps on open streams and running jobs, which free up at no known time
+        self.busy_retry_after = busy_retry_after
+        self.max_clients = max_clients
+        self.enabled = enabled
+        self.streams = 0
+        self.jobs = 0
+        self._clients: OrderedDict[str, _Client] = OrderedDict()
+
+    def _client(self, client_id: str, now: float) -> _Client:
+        client = self._clients.get(client_id)
+        if client is None:
+            client = self._clients[client_id] = _Client(self, now)
+            if len(self._clients) > self.max_clients:
+                self._forget_idle_clients()
+        else:
+            self._clients.move_to_end(client_id)
+        return client
+
+    def _forget_idle_clients(self):
+        # Least recently seen first; a forgotten idle client starts over with full buckets, as it had
+        for client_id in list(self._clients):
+            if len(self._clients) <= self.max_clients:
+                return
+            if self._clients[client_id].idle:
+                del self._clients[client_id]
+
+    def _reject(self, status_code: int, reason: str, detail: str, retry_after: float):
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        logger.debug(f"Rejected a request ({reason}): {detail}")
+        raise Rejected(status_code, reason, detail, retry_after)
+
+    def admit_stream(self, client_id: str) -> Ticket:
+        """Admit a new SSE stream; release the ticket when it ends."""
+        if not self.enabled:
+            return Ticket(None)
+        now = time.monotonic()
+        client = self._client(client_id, now)
+        if client.streams >= self.max_streams_per_client:
+            self._reject(429, "client_streams", f"At most {self.max_streams_per_client} open streams per client",
+                         self.busy_retry_after)
+        if self.streams >= self.max_streams:
+            self._reject(503, "streams", "The server has too many open streams", self.busy_retry_after)
+        wait = client.stream_opens.take(now)
+        if wait:
+            self._reject(429, "stream_rate", "Too many new streams, slow down", wait)
+        client.streams += 1
+        self.streams += 1
+
+        def release():
+            client.streams -= 1
+            self.streams -= 1
+
+        return Ticket(release)
+
+    def admit_job_start(self, client_id: str, backlog: int = 0):
+        """Check that a client may start a job now. `backlog` is the number of events queued for subscribers."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        client = self._client(client_id, now)
+        if client.jobs >= self.max_jobs_per_client:
+            self._reject(429, "client_jobs", f"At most {self.max_jobs_per_client} running jobs per client",
+                         self.busy_retry_after)
+        if self.jobs >= self.max_jobs:
+            self._reject(503, "jobs", "The server is running too many jobs", self.busy_retry_after)
+        if backlog > self.max_backlog:
+            # Subscribers are not keeping up: do not add producers until they do
+            self._reject(503, "backlog", "The server is busy sending events", self.busy_retry_after)
+        wait = client.job_starts.take(now)
+        if wait:
+            self._reject(429, "job_rate", "Too many job starts, slow down", wait)
+
+    def track_job(self, client_id: str, job) -> Optional[Ticket]:
+        """Count a started job against its client until it finishes."""
+        if not self.enabled or job.task is None or job.task.done() or job.admission_ticket is not None:
+            return None # Disabled, already finished, or an identical running job that is already counted
+        client = self._client(client_id, time.monotonic())
+        client.jobs += 1
+        self.jobs += 1
+
+        def release():
+            client.jobs -= 1
+            self.jobs -= 1
+
+        ticket = job.admission_ticket = Ticket(release)
+        job.task.add_done_callback(lambda _: ticket.release())
+        return ticket
@@ -0,0 +1,418 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Optional
+
+from sse_encoder import json_dumps
+
+logger = logging.getLogger(__name__)
+
+# Callbacks of a subscription: on_event(event_id, event, data) and on_finish(info)
+EventListener = Callable[[int, str, Any], None]
+FinishListener = Callable[[dict], None]
+
+
+class Backplane:
+    """
+    Carries job events between server processes, so that with `uvicorn --workers N`
+    a client can follow a job from any worker, not only the one running it.
+
+    The process running a job announces it, publishes its events and finishes it.
+    Other processes subscribe to it by id and get the retained history, then the live
+    events. Implementations only move these messages and keep a bounded history per
+    job: LocalBackplane does it over a Unix domain socket, and a broker such as Redis
+    (a pub/sub channel and a capped list per job) would implement the same methods.
+    """
+
+    def __init__(self):
+        # Called after every (re)connection, so owners can re-send their running jobs
+        self.on_connect: Optional[Callable[[], None]] = None
+        # Called with (topic, reason) when another process cancels a job running in this one
+        self.on_cancel: Optional[Callable[[str, str], None]] = None
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def announce(self, topic: str, info: dict):
+        """A job started in this process; `info` is its status (Job.to_dict())."""
+        raise NotImplementedError
+
+    def publish(self, topic: str, event_id: int, event: str, data: Any):
+        raise NotImplementedError
+
+    def finish(self, topic: str, info: dict):
+        raise NotImplementedError
+
+    async def subscribe(self, topic: str, on_event: EventListener, on_finish: FinishListener,
+                        last_event_id: Optional[int] = None) -> Optional[dict]:
+        """
+        Follow a job running in another process. Returns its info, or None if no
+        process knows the job. Events after `last_event_id` (all retained ones if
+        None) are passed to `on_event`, and `on_finish` is called once it ends.
+        """
+        raise NotImplementedError
+
+    def unsubscribe(self, topic: str):
+        raise NotImplementedError
+
+    def cancel(self, topic: str, reason: str):
+        """Ask the process running a job to cancel it (see `on_cancel`)."""
+        raise NotImplementedError
+
+    def followers(self, topic: str) -> int:
+        """How many other processes follow a job running in this one."""
+        return 0
+
+
+# --- Wire format: one JSON object per line ---
+# The hub forwards event and finish lines to subscribers as they were received,
+# so an event is serialized once by its owner, however many processes follow it.
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+
+def _encode(message: dict) -> bytes:
+    return json_dumps(message) + b"\n"
+
+
+# Sent to subscribers of a job whose process stopped before finishing it
+OWNER_LOST_ERROR = {"error": "The server process running this job stopped."}
+
+
+class _Topic:
+    def __init__(self, history_size: int):
+        self.info: Optional[dict] = None
+        self.owner: Optional["_Peer"] = None
+        self.history: deque[tuple[int, bytes]] = deque(maxlen=history_size)
+        self.last_id = 0
+        self.finish_line: Optional[bytes] = None
+        self.subscribers: set["_Peer"] = set()
+
+
+class _Peer:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.topics: set[str] = set() # Subscribed or owned
+
+    def send(self, line: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(line)
+
+
+class BackplaneHub:
+    """
+    Fan-out server that one of the processes runs for all of them (see LocalBackplane).
+    It keeps the last `history_size` events of every job, and finished jobs for
+    `retention_seconds`, so a process that subscribes late can still replay them.
+    """
+
+    def __init__(self, path: str, history_size: int = 1000, retention_seconds: float = 300.0):
+        self.path = path
+        self.history_size = history_size
+        self.retention_seconds = retention_seconds
+        self._topics: dict[str, _Topic] = {}
+        self._peers: set[_Peer] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        # Whoever ran the hub before is gone (we hold the lock), so its socket file is stale
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path, limit=MAX_LINE_BYTES)
+        logger.info(f"Backplane hub listening on {self.path} (pid {os.getpid()})")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Since Python 3.12.1, wait_closed() also waits for the open connections to end
+            for peer in list(self._peers):
+                peer.writer.close()
+            await self._server.wait_closed()
+            self._server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _topic(self, name: str) -> _Topic:
+        topic = self._topics.get(name)
+        if topic is None:
+            topic = self._topics[name] = _Topic(self.history_size)
+        return topic
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = _Peer(writer)
+        self._peers.add(peer)
+        try:
+            while line := await reader.readline():
+                self._handle(peer, line)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning(f"Backplane connection lost: {e}")
+        finally:
+            self._peers.discard(peer)
+            self._drop_peer(peer)
+            writer.close()
+
+    def _handle(self, peer: _Peer, line: bytes):
+        message = json.loads(line)
+        op, name = message["op"], message["topic"]
+        topic = self._topic(name)
+        if op == "event":
+            if message["id"] <= topic.last_id:
+                return # Re-sent by an owner after a reconnect
+            topic.last_id = message["id"]
+            topic.history.append((topic.last_id, line))
+            for subscriber in topic.subscribers:
+                subscriber.send(line)
+        elif op == "announce":
+            topic.info = message["info"]
+            topic.owner = peer
+            peer.topics.add(name)
+            # Subscribers that got here first (e.g. after a hub restart) learn the job exists
+            for subscriber in topic.subscribers:
+                subscriber.send(_encode({"op": "attached", "topic": name, "info": topic.info}))
+            self._send_followers(name, topic)
+        elif op == "finish":
+            topic.info = message["info"]
+            topic.finish_line = line
+            topic.owner = None
+            for subscriber in topic.subscribers:
+                subscriber.send(line)
+            asyncio.get_running_loop().call_later(self.retention_seconds, self._topics.pop, name, None)
+        elif op == "subscribe":
+            topic.subscribers.add(peer)
+            peer.topics.add(name)
+            # The history is sent right after the reply, so nothing can come in between
+            peer.send(_encode({"op": "attached", "topic": name, "info": topic.info}))
+            last_id = message.get("last_id") or 0
+            for event_id, event_line in topic.history:
+                if event_id > last_id:
+                    peer.send(event_line)
+            if topic.finish_line is not None:
+                peer.send(topic.finish_line)
+            self._send_followers(name, topic)
+        elif op == "unsubscribe":
+            topic.subscribers.discard(peer)
+            self._send_followers(name, topic)
+            self._forget_if_unused(name, topic)
+        elif op == "cancel":
+            if topic.owner is not None:
+                topic.owner.send(line)
+            self._forget_if_unused(name, topic)
+
+    def _send_followers(self, name: str, topic: _Topic):
+        # The owner cancels jobs nobody follows, so it needs to know about other processes' subscribers
+        if topic.owner is not None:
+            topic.owner.send(_encode({"op": "followers", "topic": name, "count": len(topic.subscribers)}))
+
+    def _forget_if_unused(self, name: str, topic: _Topic):
+        # Subscribing to an unknown job leaves an empty topic behind
+        if topic.info is None and not topic.subscribers:
+            self._topics.pop(name, None)
+
+    def _drop_peer(self, peer: _Peer):
+        for name in peer.topics:
+            topic = self._topics.get(name)
+            if topic is None:
+                continue
+            if peer in topic.subscribers:
+                topic.subscribers.discard(peer)
+                self._send_followers(name, topic)
+            if topic.owner is peer and topic.finish_line is None:
+                # The process running the job stopped; its subscribers would wait forever
+                logger.warning(f"Owner of job {name} disconnected; marking it as failed.")
+                event_id = topic.last_id + 1
+                self._handle(peer, _encode({
+                    "op": "event", "topic": name, "id": event_id, "event": "error", "data": OWNER_LOST_ERROR,
+                }))
+                self._handle(peer, _encode({"op": "finish", "topic": name, "info": {**topic.info, "status": "failed", "finished_at": time.time()}}))
+            self._forget_if_unused(name, topic)
+
+
+class _Subscription:
+    def __init__(self, on_event: EventListener, on_finish: FinishListener, last_id: Optional[int]):
+        self.on_event = on_event
+        self.on_finish = on_finish
+        self.last_id = last_id or 0
+        self.orphan_timer: Optional[asyncio.TimerHandle] = None
+
+
+class LocalBackplane(Backplane):
+    """
+    Backplane for the processes of one machine, over a Unix domain socket at `path`.
+    No extra service is needed: the first process to take the lock file next to the
+    socket runs the hub, and every process (that one included) connects to it.
+    If the hub's process stops, the others reconnect and one of them takes over;
+    owners then re-send their running jobs (see `on_connect`), and subscribers
+    resume after the last event they received. A followed job that no process
+    re-sends within `orphan_timeout` seconds stopped with the hub, and is
+    ended with an error.
+    """
+
+    def __init__(self, path: str, history_size: int = 1000, retention_seconds: float = 300.0,
+                 orphan_timeout: float = 10.0):
+        super().__init__()
+        self.path = path
+        self.history_size = history_size
+        self.retention_seconds = retention_seconds
+        self.orphan_timeout = orphan_timeout
+        self._hub: Optional[BackplaneHub] = None
+        self._lock_file = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._subscriptions: dict[str, _Subscription] = {}
+        self._pending: dict[str, asyncio.Future] = {}
+        self._followers: dict[str, int] = {} # Of the jobs running here, as told by the hub
+        self._connected = asyncio.Event()
+
+    async def start(self):
+        self._reader_task = asyncio.create_task(self._run())
+        await self._connected.wait()
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._hub is not None:
+            await self._hub.close()
+            self._hub = None
+        if self._lock_file is not None:
+            self._lock_file.close() # Releases the lock, so another process can run the hub
+            self._lock_file = None
+
+    async def _try_to_become_hub(self):
+        if self._hub is not None:
+            return
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return # Another process runs the hub
+        self._hub = BackplaneHub(self.path, self.history_size, self.retention_seconds)
+        await self._hub.start()
+
+    async def _connect(self) -> asyncio.StreamReader:
+        delay = 0.05
+        while True:
+            await self._try_to_become_hub()
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE_BYTES)
+                return reader
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The hub is starting, or its process just stopped
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    async def _run(self):
+        """Keeps the connection to the hub open and dispatches what it sends."""
+        while True:
+            reader = await self._connect()
+            for topic, subscription in self._subscriptions.items():
+                self._send({"op": "subscribe", "topic": topic, "last_id": subscription.last_id})
+            if self.on_connect is not None:
+                self.on_connect()
+            self._connected.set()
+            try:
+                while line := await reader.readline():
+                    self._dispatch(json.loads(line))
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                logger.warning(f"Backplane connection lost: {e}")
+            finally:
+                # Also when close() cancels us: the hub waits for this connection to end
+                self._connected.clear()
+                self._writer.close()
+                self._writer = None
+            logger.warning("Disconnected from the backplane hub, reconnecting.")
+
+    def _dispatch(self, message: dict):
+        op, topic = message["op"], message["topic"]
+        # Messages for the owner of a job
+        if op == "followers":
+            self._followers[topic] = message["count"]
+            return
+        if op == "cancel":
+            if self.on_cancel is not None:
+                self.on_cancel(topic, message["reason"])
+            return
+        pending = self._pending.pop(topic, None) if op == "attached" else None
+        if pending is not None and not pending.done():
+            pending.set_result(message["info"])
+            return
+        subscription = self._subscriptions.get(topic)
+        if subscription is None:
+            return
+        if op == "attached":
+            # Reply to a subscription renewed after a reconnect
+            if message["info"] is None and subscription.orphan_timer is None:
+                subscription.orphan_timer = asyncio.get_running_loop().call_later(
+                    self.orphan_timeout, self._end_orphan, topic
+                )
+            elif message["info"] is not None and subscription.orphan_timer is not None:
+                subscription.orphan_timer.cancel()
+                subscription.orphan_timer = None
+        elif op == "event":
+            # Skips what was already received before a reconnect
+            if message["id"] > subscription.last_id:
+                subscription.last_id = message["id"]
+                subscription.on_event(message["id"], message["event"], message["data"])
+        elif op == "finish":
+            subscription.on_finish(message["info"])
+
+    def _end_orphan(self, topic: str):
+        subscription = self._subscriptions.get(topic)
+        if subscription is None:
+            return
+        logger.warning(f"Job {topic} was not re-sent after the backplane reconnected; ending it as failed.")
+        subscription.on_event(subscription.last_id + 1, "error", OWNER_LOST_ERROR)
+        subscription.on_finish({"status": "failed", "finished_at": time.time()})
+        self.unsubscribe(topic)
+
+    def _send(self, message: dict):
+        # Messages sent while reconnecting are lost; owners re-send on_connect
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_encode(message))
+
+    def announce(self, topic: str, info: dict):
+        self._send({"op": "announce", "topic": topic, "info": info})
+
+    def publish(self, topic: str, event_id: int, event: str, data: Any):
+        self._send({"op": "event", "topic": topic, "id": event_id, "event": event, "data": data})
+
+    def finish(self, topic: str, info: dict):
+        self._followers.pop(topic, None)
+        self._send({"op": "finish", "topic": topic, "info": info})
+
+    def cancel(self, topic: str, reason: str):
+        self._send({"op": "cancel", "topic": topic, "reason": reason})
+
+    def followers(self, topic: str) -> int:
+        return self._followers.get(topic, 0)
+
+    async def subscribe(self, topic: str, on_event: EventListener, on_finish: FinishListener,
+                        last_event_id: Optional[int] = None) -> Optional[dict]:
+        await self._connected.wait()
+        reply = self._pending.get(topic)
+        if reply is None:
+            reply = self._pending[topic] = asyncio.get_running_loop().create_future()
+        self._subscriptions[topic] = _Subscription(on_event, on_finish, last_event_id)
+        self._send({"op": "subscribe", "topic": topic, "last_id": last_event_id})
+        info = await reply
+        if info is None:
+            self.unsubscribe(topic)
+        return info
+
+    def unsubscribe(self, topic: str):
+        subscription = self._subscriptions.pop(topic, None)
+        if subscription is not None:
+            if subscription.orphan_timer is not None:
+                subscription.orphan_timer.cancel()
+            self._send({"op": "unsubscribe", "topic": topic})
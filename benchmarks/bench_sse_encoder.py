@@ -0,0 +1,103 @@
+"""
+Micro-benchmark: the old f-string SSE frames vs. the bytes encoder in sse_encoder.py.
+
+Two things are measured for each event count:
+  * encode only: turning an event into the bytes that go on the wire
+  * stream: encoding plus one `await send(...)` per write, like Starlette's
+    StreamingResponse does, for one or more subscribers of the same events.
+    The old path serializes per subscriber and writes once per event; the new
+    path encodes once and coalesces up to --batch frames per write.
+
+Usage (from the project root):
+    python benchmarks/bench_sse_encoder.py
+    python benchmarks/bench_sse_encoder.py --events 10000 100000 1000000 --batch 64 --subscribers 10
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+# Allow running this file directly from the project root or the benchmarks folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sse_encoder
+from sse_encoder import encode_event, join_frames
+
+# A pool of payloads, so building them is not part of what is measured
+PAYLOADS = [{"percent": i % 101, "message": f"Sum Operation Complete. Status: step {i}"} for i in range(1000)]
+
+
+async def fake_send(message):
+    """Stands in for the ASGI send() of the server; the cost of an await is what matters."""
+    return None
+
+
+def fstring_encode(n, args):
+    """What main_progress.py used to do: build a str, which Starlette then encodes."""
+    for i in range(n):
+        frame = f"id: {i}\nevent: progress\ndata: {json.dumps(PAYLOADS[i % 1000])}\n\n"
+        frame.encode("utf-8")
+
+
+def encoder_encode(n, args):
+    for i in range(n):
+        encode_event(PAYLOADS[i % 1000], "progress", i)
+
+
+async def fstring_stream(n, args):
+    # Every subscriber had its own generator, so every event was serialized per subscriber
+    for i in range(n):
+        for _ in range(args.subscribers):
+            frame = f"id: {i}\nevent: progress\ndata: {json.dumps(PAYLOADS[i % 1000])}\n\n"
+            await fake_send({"type": "http.response.body", "body": frame.encode("utf-8"), "more_body": True})
+
+
+async def encoder_stream(n, args):
+    # Encoded once by the broker, then sent in batches to every subscriber
+    for start in range(0, n, args.batch):
+        frames = [encode_event(PAYLOADS[i % 1000], "progress", i) for i in range(start, min(start + args.batch, n))]
+        for _ in range(args.subscribers):
+            for chunk in join_frames(frames):
+                await fake_send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+
+def run(name, func, n, args):
+    start = time.perf_counter()
+    result = func(n, args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<34} {elapsed:8.3f}s  {n / elapsed:>12,.0f} events/s  {elapsed / n * 1e6:7.2f} us/event")
+    return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--batch", type=int, default=64, help="Frames per write for the encoder stream")
+    parser.add_argument("--subscribers", type=int, default=1, help="Subscribers receiving the same events")
+    args = parser.parse_args()
+
+    backends = [("stdlib json", sse_encoder._stdlib_json_dumps)]
+    if sse_encoder.orjson is not None:
+        backends.append(("orjson", sse_encoder._orjson_dumps))
+    else:
+        print("(orjson is not installed, only the stdlib JSON backend is measured)")
+
+    for n in args.events:
+        print(f"\n--- {n:,} events, {args.subscribers} subscriber(s), batch {args.batch} ---")
+        encode_baseline = run("encode: f-string + str.encode", fstring_encode, n, args)
+        stream_baseline = run("stream: f-string, 1 write/event", fstring_stream, n, args)
+        for label, dumps in backends:
+            sse_encoder.set_json_dumps(dumps)
+            rate = run(f"encode: encoder ({label})", encoder_encode, n, args)
+            print(f"{'':<34} {rate / encode_baseline:.2f}x vs f-string")
+            rate = run(f"stream: encoder+batch ({label})", encoder_stream, n, args)
+            print(f"{'':<34} {rate / stream_baseline:.2f}x vs f-string")
+        sse_encoder.set_json_dumps(None)
+
+
+if __name__ == "__main__":
+    main()
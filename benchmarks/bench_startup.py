@@ -0,0 +1,190 @@
+"""
+Startup benchmark: how long a fresh server process takes before it can serve.
+Every number comes from new Python processes, so nothing is already imported
+or cached in memory (the modules are byte-compiled first, as in production):
+
+  * interpreter:  `python -c pass`, the floor every process pays
+  * import:       `import main_progress` (what tools and tests pay)
+  * create_app:   main_progress.create_app() after that: logging, the optional
+                  backends and building the routes
+  * first response: from starting `uvicorn main_progress:app` to the first
+                  answer to GET /metrics (what a new worker or replica pays)
+
+plus a `python -X importtime` report of the import: the modules main_progress
+imports directly and the slowest modules overall, by median over the runs.
+
+Usage (from the project root):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --top 25 --output startup.json
+    JOB_LOG_DIR=/tmp/job-logs python benchmarks/bench_startup.py --no-server
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+HOST = "127.0.0.1"
+MODULE = "main_progress"
+
+# Run in a fresh interpreter; prints the wall times of the import and of create_app() in ms
+TIMING_SCRIPT = f"""
+import json, time
+started = time.perf_counter()
+import {MODULE}
+imported = time.perf_counter()
+{MODULE}.create_app()
+created = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000}}))
+"""
+
+
+def run_python(*args):
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, *args], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+    )
+    return completed, (time.perf_counter() - started) * 1000
+
+
+def parse_importtime(stderr):
+    """{module: (self us, cumulative us, depth)} from the -X importtime lines of one run."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue # The header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.setdefault(name.strip(), (int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def importtime_report(runs, top):
+    parsed = [parse_importtime(run_python("-X", "importtime", "-c", f"import {MODULE}")[0].stderr)
+              for _ in range(runs)]
+
+    def median_us(name, index):
+        return statistics.median(run[name][index] for run in parsed if name in run)
+
+    names = set().union(*parsed)
+    # Direct imports: one level below main_progress, and imported while main_progress was
+    order = list(parsed[0])
+    end = order.index(MODULE)
+    start = max((i for i in range(end) if parsed[0][order[i]][2] == 0), default=-1) + 1
+    direct = [name for name in order[start:end] if parsed[0][name][2] == 1]
+    return {
+        "module_cumulative_ms": median_us(MODULE, 1) / 1000,
+        "modules_imported": statistics.median(len(run) for run in parsed),
+        "direct_imports": sorted(
+            ({"module": name, "cumulative_ms": median_us(name, 1) / 1000} for name in direct),
+            key=lambda entry: entry["cumulative_ms"], reverse=True,
+        )[:top],
+        "slowest_modules": sorted(
+            ({"module": name, "self_ms": median_us(name, 0) / 1000} for name in names),
+            key=lambda entry: entry["self_ms"], reverse=True,
+        )[:top],
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_response(timeout=30.0):
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{MODULE}:app", "--host", HOST, "--port", str(port),
+         "--log-level", "warning"],
+        cwd=PROJECT_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f"http://{HOST}:{port}/metrics", timeout=1) as response:
+                    response.read()
+                return (time.perf_counter() - started) * 1000
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise TimeoutError(f"The server did not answer within {timeout} s")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def summarize(values):
+    return {"median_ms": statistics.median(values), "min_ms": min(values), "max_ms": max(values)}
+
+
+def print_report(result):
+    print(f"\nStartup of {MODULE} ({result['runs']} runs, median [min - max]):")
+    for key, label in (("interpreter", "Interpreter"), ("import", "Import"), ("create_app", "create_app()"),
+                       ("first_response", "First response")):
+        if key in result:
+            stats = result[key]
+            print(f"  {label + ':':<16} {stats['median_ms']:8.1f} ms  [{stats['min_ms']:.1f} - {stats['max_ms']:.1f}]")
+    report = result["importtime"]
+    print(f"\n-X importtime: {report['module_cumulative_ms']:.1f} ms, {report['modules_imported']:.0f} modules")
+    print("  Direct imports (cumulative):")
+    for entry in report["direct_imports"]:
+        print(f"    {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+    print("  Slowest modules (self):")
+    for entry in report["slowest_modules"]:
+        print(f"    {entry['self_ms']:8.1f} ms  {entry['module']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Fresh processes per measurement")
+    parser.add_argument("--top", type=int, default=15, help="Modules listed in the importtime report")
+    parser.add_argument("--no-server", action="store_true", help="Do not measure the time to the first response")
+    parser.add_argument("--output", type=Path, default=None, help="JSON file to write (default: benchmarks/results/)")
+    args = parser.parse_args()
+
+    # The project's .pyc files, which a deployed server has too (even with PYTHONDONTWRITEBYTECODE set)
+    run_python("-m", "compileall", "-q", "-l", ".")
+
+    result = {"runs": args.runs}
+    result["interpreter"] = summarize([run_python("-c", "pass")[1] for _ in range(args.runs)])
+    timings = [json.loads(run_python("-c", TIMING_SCRIPT)[0].stdout) for _ in range(args.runs)]
+    result["import"] = summarize([timing["import_ms"] for timing in timings])
+    result["create_app"] = summarize([timing["create_app_ms"] for timing in timings])
+    if not args.no_server:
+        result["first_response"] = summarize([time_to_first_response() for _ in range(args.runs)])
+    result["importtime"] = importtime_report(args.runs, args.top)
+    result["metadata"] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "env": {name: os.environ[name] for name in ("BACKPLANE_SOCKET", "JOB_LOG_DIR") if name in os.environ},
+    }
+    print_report(result)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = PROJECT_ROOT / "benchmarks" / "results" / f"startup_{stamp}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
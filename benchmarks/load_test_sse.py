@@ -0,0 +1,322 @@
+"""
+Load test for the SSE endpoints: opens many concurrent streams against a
+server on localhost and reports connection rate, event latency, memory per
+connection and CPU per event. Results are written as JSON, so runs can be
+compared between releases.
+
+Only ever runs against localhost: the server is started by this script.
+
+Usage (from the project root):
+    python benchmarks/load_test_sse.py --clients 1000
+    python benchmarks/load_test_sse.py --clients 2000 --mode per-client --output results.json
+    python benchmarks/load_test_sse.py --clients 200 --in-process
+
+Modes:
+    shared      one job is started with POST /jobs and every client subscribes to it (default)
+    per-client  every client opens GET /stream-progress?share=false, which starts a job of its own
+
+By default the server runs in its own uvicorn process, so its memory and CPU
+can be measured without the client's. With --in-process it runs in a thread
+of this process instead, and memory/CPU numbers include the client.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+HOST = "127.0.0.1"
+
+
+# --- Server process measurements (Linux /proc) ---
+def read_rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        # utime and stime are fields 14 and 15 of the file (11 and 12 after the command name)
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def raise_fd_limit(needed):
+    """Each connection needs a file descriptor (two with an in-process server)."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, needed))
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    if wanted < needed:
+        print(f"Warning: the file descriptor limit ({wanted}) is lower than the {needed} needed.")
+
+
+class SubprocessServer:
+    def __init__(self, port):
+        self.port = port
+        self.process = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main_progress:app", "--host", HOST,
+             "--port", str(self.port), "--log-level", "warning"],
+            cwd=PROJECT_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env={**os.environ, "ADMISSION_CONTROL": "off"}, # All clients share one address here
+        )
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class InProcessServer:
+    def __init__(self, port):
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def pid(self):
+        return os.getpid()
+
+    def start(self):
+        import logging
+        import uvicorn
+        sys.path.insert(0, str(PROJECT_ROOT))
+        os.environ.setdefault("ADMISSION_CONTROL", "off") # All clients share one address here
+        import main_progress
+        # Same log level as the subprocess server, and no httpx request logs
+        logging.getLogger().setLevel(logging.WARNING)
+        config = uvicorn.Config(main_progress.app, host=HOST, port=self.port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+async def wait_until_ready(client, base_url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get(f"{base_url}/jobs/ready-check")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server at {base_url} did not start within {timeout}s")
+
+
+# --- One SSE client ---
+async def run_client(client, url, connect_slots, stats):
+    """Reads one stream until the 'complete' event and records timings."""
+    record = {"connected": None, "first_event": None, "gaps": [], "events": 0, "error": None}
+    started = time.perf_counter()
+    await connect_slots.acquire()
+    try:
+        async with client.stream("GET", url, headers={"Accept": "text/event-stream"}) as response:
+            response.raise_for_status()
+            record["connected"] = time.perf_counter() - started
+            stats["connected"] += 1
+            connect_slots.release()
+            last_event_at = None
+            event_name, has_data = None, False
+            async for line in response.aiter_lines():
+                if line.startswith("event:"):
+                    event_name = line[6:].strip()
+                elif line.startswith("data:"):
+                    has_data = True
+                elif line == "":
+                    # End of a frame; retry-only frames and ': ping' comments carry no data
+                    if has_data:
+                        now = time.perf_counter()
+                        if last_event_at is None:
+                            record["first_event"] = now - started
+                        else:
+                            record["gaps"].append(now - last_event_at)
+                        last_event_at = now
+                        record["events"] += 1
+                        if event_name in ("complete", "error"):
+                            break
+                    event_name, has_data = None, False
+    except (httpx.HTTPError, OSError) as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if record["connected"] is None:
+            connect_slots.release()
+    return record
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    ms = [value * 1000 for value in values]
+    return {
+        "count": len(ms),
+        "mean_ms": statistics.fmean(ms),
+        "p50_ms": percentile(ms, 50),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms),
+    }
+
+
+async def run_load_test(args, server):
+    base_url = f"http://{HOST}:{server.port}"
+    limits = httpx.Limits(max_connections=args.clients + 10, max_keepalive_connections=args.clients + 10)
+    timeout = httpx.Timeout(args.timeout, connect=args.timeout)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        await wait_until_ready(client, base_url)
+        rss_before = read_rss_bytes(server.pid)
+        cpu_before = read_cpu_seconds(server.pid)
+
+        if args.mode == "shared":
+            job = (await client.post(f"{base_url}/jobs")).json()
+            url = f"{base_url}{job['stream_url']}"
+        else:
+            # Without share=false, identical requests would attach to one job or replay its cached result
+            url = f"{base_url}/stream-progress?share=false"
+
+        stats = {"connected": 0}
+        peak_rss = rss_before
+        connect_slots = asyncio.Semaphore(args.connect_concurrency)
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(run_client(client, url, connect_slots, stats)) for _ in range(args.clients)]
+
+        # Sample the server's memory while the streams are open
+        connected_at = None
+        while not all(task.done() for task in tasks):
+            rss = read_rss_bytes(server.pid)
+            if rss is not None and peak_rss is not None:
+                peak_rss = max(peak_rss, rss)
+            if connected_at is None and stats["connected"] >= args.clients:
+                connected_at = time.perf_counter()
+            await asyncio.sleep(0.05)
+        records = [task.result() for task in tasks]
+        elapsed = time.perf_counter() - started
+        cpu_after = read_cpu_seconds(server.pid)
+
+    ok = [record for record in records if record["error"] is None]
+    connect_times = [record["connected"] for record in ok if record["connected"] is not None]
+    ramp_seconds = (connected_at - started) if connected_at else max(connect_times, default=0)
+    total_events = sum(record["events"] for record in ok)
+    cpu_seconds = (cpu_after - cpu_before) if None not in (cpu_before, cpu_after) else None
+    errors = [record["error"] for record in records if record["error"]]
+
+    return {
+        "clients": args.clients,
+        "mode": args.mode,
+        "server": "in-process" if args.in_process else "subprocess",
+        "successful_clients": len(ok),
+        "failed_clients": len(errors),
+        "sample_errors": sorted(set(errors))[:5],
+        "duration_s": elapsed,
+        "connections_per_second": len(connect_times) / ramp_seconds if ramp_seconds else None,
+        "connect_latency": summarize(connect_times),
+        "first_event_latency": summarize([record["first_event"] for record in ok if record["first_event"] is not None]),
+        "inter_event_latency": summarize([gap for record in ok for gap in record["gaps"]]),
+        "events_received": total_events,
+        "server_rss_before_bytes": rss_before,
+        "server_rss_peak_bytes": peak_rss,
+        "memory_per_connection_bytes": (peak_rss - rss_before) / args.clients if rss_before and peak_rss else None,
+        "server_cpu_seconds": cpu_seconds,
+        "cpu_per_event_us": cpu_seconds / total_events * 1e6 if cpu_seconds is not None and total_events else None,
+    }
+
+
+def print_report(result):
+    def fmt(value, unit="", scale=1.0, digits=1):
+        return "n/a" if value is None else f"{value * scale:,.{digits}f}{unit}"
+
+    print(f"\nClients: {result['successful_clients']}/{result['clients']} ok ({result['mode']}, {result['server']} server)")
+    print(f"Connections per second:  {fmt(result['connections_per_second'])}")
+    for key, label in (("first_event_latency", "First event"), ("inter_event_latency", "Inter-event")):
+        stats = result[key]
+        print(f"{label + ' latency:':<24} p50 {fmt(stats.get('p50_ms'), ' ms')}   p99 {fmt(stats.get('p99_ms'), ' ms')}   (n={stats['count']})")
+    print(f"Memory per connection:   {fmt(result['memory_per_connection_bytes'], ' KiB', 1 / 1024)}")
+    print(f"CPU per event:           {fmt(result['cpu_per_event_us'], ' us')}")
+    if result["sample_errors"]:
+        print(f"Errors: {result['sample_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500, help="Concurrent SSE connections to open")
+    parser.add_argument("--mode", choices=("shared", "per-client"), default="shared")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="Connections being opened at the same time")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds before a connection or read times out")
+    parser.add_argument("--in-process", action="store_true", help="Run the server in a thread of this process")
+    parser.add_argument("--port", type=int, default=None, help="Port to use on 127.0.0.1 (default: a free one)")
+    parser.add_argument("--output", type=Path, default=None, help="JSON file to write (default: benchmarks/results/)")
+    args = parser.parse_args()
+
+    raise_fd_limit(args.clients * (2 if args.in_process else 1) + 100)
+    port = args.port or free_port()
+    server = InProcessServer(port) if args.in_process else SubprocessServer(port)
+    server.start()
+    try:
+        result = asyncio.run(run_load_test(args, server))
+    finally:
+        server.stop()
+
+    result["metadata"] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    print_report(result)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = PROJECT_ROOT / "benchmarks" / "results" / f"load_test_{args.mode}_{args.clients}_{stamp}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
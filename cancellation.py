@@ -0,0 +1,34 @@
+class Cancelled(Exception):
+    """Raised inside a step by CancellationToken.raise_if_cancelled() once its job was cancelled."""
+
+
+class CancellationToken:
+    """
+    Handle passed to a step so that it can stop early when its job is cancelled
+    (DELETE /jobs/{job_id}, or nobody follows the job any more):
+
+        for item in items:
+            cancel_token.raise_if_cancelled()
+            process(item)
+
+    Async steps are interrupted at their next await anyway, but a plain function
+    in a thread or process pool cannot be stopped from the outside: it has to
+    check the token. Checking is a flag read, cheap enough for every iteration.
+    A ProgressReporter given the same token checks it on every update().
+    """
+
+    __slots__ = ("_cancelled",)
+
+    def __init__(self):
+        self._cancelled = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        self._cancelled = True
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise Cancelled()
@@ -0,0 +1,281 @@
+import asyncio
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Any, BinaryIO, Optional
+
+from metrics import JOB_LOG_BYTES_WRITTEN, JOB_LOG_FSYNC_SECONDS
+from sse_encoder import json_dumps
+
+logger = logging.getLogger(__name__)
+
+# --- File format ---
+# A file starts with MAGIC, followed by records: a header (payload length, CRC32,
+# kind, event id) and a JSON payload. The CRC covers kind, id and payload, so a
+# record that was only partly written before a crash is recognized and ignored.
+MAGIC = b"JOBLOG1\n"
+HEADER = struct.Struct("<IIBI")
+INFO, EVENT, FINISH = 1, 2, 3  # Record kinds: job info, one event, final job info
+
+
+def _record(kind: int, event_id: int, payload: bytes) -> bytes:
+    crc = zlib.crc32(payload, zlib.crc32(bytes((kind,)) + event_id.to_bytes(4, "little")))
+    return HEADER.pack(len(payload), crc, kind, event_id) + payload
+
+
+def read_records(path: str) -> tuple[list[tuple[int, int, bytes]], int]:
+    """
+    Read all intact records of a log through a memory map (no copy of the whole file).
+    Returns them with the offset where the intact part of the file ends.
+    """
+    records = []
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < len(MAGIC):
+            return records, 0
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            if view[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not a job log: {path}")
+            offset = len(MAGIC)
+            while offset + HEADER.size <= size:
+                length, crc, kind, event_id = HEADER.unpack_from(view, offset)
+                start, end = offset + HEADER.size, offset + HEADER.size + length
+                if end > size:
+                    break # Torn write at the end of the file
+                payload = view[start:end]
+                if zlib.crc32(payload, zlib.crc32(view[offset + 8:start])) != crc:
+                    break
+                records.append((kind, event_id, payload))
+                offset = end
+    return records, offset
+
+
+class JobLog:
+    """What a log file holds about one job, as read back by JobLogStore.load()."""
+
+    def __init__(self, info: dict, events: list[tuple[int, str, Any]], finished: bool, end_offset: int):
+        self.info = info
+        self.events = events  # (event id, event, data)
+        self.finished = finished
+        self.end_offset = end_offset
+
+
+class _Writer:
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.events = 0
+        self.dirty = False
+        self.finished = False
+
+
+class JobLogStore:
+    """
+    Keeps an append-only log file per job in `directory`, so the history of a job
+    survives a restart of the server and can be replayed to reconnecting clients.
+
+    Appending only writes to a buffer on the event loop. Every `fsync_interval`
+    seconds a background thread writes the buffers out and fsyncs them, so a burst
+    of events costs one fsync, not one per event; at most that much is lost on a crash.
+    Logs of finished jobs are compacted to their last `max_events` events (what a
+    client can still replay anyway), deleted `retention_seconds` after they were
+    last written, and the oldest are deleted when all logs take more than `max_bytes`.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = 1.0, max_events: int = 1000,
+                 retention_seconds: float = 7 * 24 * 3600, max_bytes: int = 1024 ** 3,
+                 sweep_interval: float = 60.0):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.max_events = max_events
+        self.retention_seconds = retention_seconds
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._writers: dict[str, _Writer] = {}
+        self._task: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id: str) -> Optional[str]:
+        # Job ids come from URLs; anything but a plain id could escape the directory
+        if not job_id.isalnum():
+            return None
+        return os.path.join(self.directory, f"{job_id}.log")
+
+    # --- Writing (the same methods as a Backplane, see Job) ---
+    def announce(self, job_id: str, info: dict):
+        file = open(self.path(job_id), "ab")
+        # Held while the job runs (until the file is closed), so other processes know it is live
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        if file.tell() == 0:
+            file.write(MAGIC)
+        file.write(_record(INFO, 0, json_dumps(info)))
+        self._writers[job_id] = _Writer(file)
+
+    def publish(self, job_id: str, event_id: int, event: str, data: Any):
+        writer = self._writers.get(job_id)
+        if writer is None:
+            return
+        record = _record(EVENT, event_id, json_dumps([event, data]))
+        writer.file.write(record)
+        writer.events += 1
+        writer.dirty = True
+        JOB_LOG_BYTES_WRITTEN.inc(len(record))
+
+    def finish(self, job_id: str, info: dict):
+        writer = self._writers.get(job_id)
+        if writer is None:
+            return
+        writer.file.write(_record(FINISH, 0, json_dumps(info)))
+        writer.dirty = True
+        writer.finished = True # Synced, compacted and closed by the next flush
+
+    # --- Background flushing ---
+    async def start(self):
+        await asyncio.to_thread(self.sweep)
+        self._task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        for writer in self._writers.values():
+            writer.file.close()
+        self._writers.clear()
+
+    async def _flush_periodically(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.monotonic()
+                    await asyncio.to_thread(self.sweep)
+            except OSError as e:
+                logger.error(f"Writing job logs failed: {e}")
+
+    async def flush(self):
+        """Write out and fsync every log with new records, then close the finished ones."""
+        dirty = [(job_id, writer) for job_id, writer in self._writers.items() if writer.dirty]
+        if not dirty:
+            return
+        for job_id, writer in dirty:
+            writer.dirty = False
+            if writer.finished:
+                del self._writers[job_id]
+        started = time.perf_counter()
+        await asyncio.to_thread(self._sync, dirty)
+        JOB_LOG_FSYNC_SECONDS.observe(time.perf_counter() - started)
+
+    def _sync(self, dirty: list[tuple[str, _Writer]]):
+        # Runs in a worker thread; the buffered files lock around each write
+        for job_id, writer in dirty:
+            writer.file.flush()
+            os.fsync(writer.file.fileno())
+            if writer.finished:
+                writer.file.close()
+                if writer.events > self.max_events:
+                    self.compact(job_id)
+
+    # --- Reading ---
+    def load(self, job_id: str) -> Optional[JobLog]:
+        """Read the log of a job that is not written by this process, or None if there is none."""
+        path = self.path(job_id)
+        if path is None or job_id in self._writers or not os.path.exists(path):
+            return None
+        try:
+            records, end_offset = read_records(path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read the log of job {job_id}: {e}")
+            return None
+        if not records or records[0][0] != INFO:
+            return None
+        info, events, finished = json.loads(records[0][2]), [], False
+        for kind, event_id, payload in records[1:]:
+            if kind == EVENT:
+                event, data = json.loads(payload)
+                events.append((event_id, event, data))
+            elif kind == FINISH:
+                info, finished = {**info, **json.loads(payload)}, True
+        return JobLog(info, events, finished, end_offset)
+
+    def finish_interrupted(self, job_id: str, event: str, data: Any, info: dict) -> Optional[JobLog]:
+        """
+        Close the log of a job that was interrupted by a restart with a last event and
+        `info` (written right away), and return the log as it is then.
+        While the process running a job is alive, it holds a lock on the log (see
+        announce()): then the job is not interrupted, only out of sight (no backplane,
+        or it missed the job), and None is returned without writing anything.
+        Every worker process asked for the job can get here; they take turns with a
+        lock on the directory and read the log again, so only the first one writes.
+        """
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            fcntl.flock(directory, fcntl.LOCK_EX)
+            with open(self.path(job_id), "r+b") as file:
+                try:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None # Still running in another process
+                log = self.load(job_id)
+                if log is None or log.finished:
+                    return log
+                event_id = (log.events[-1][0] if log.events else 0) + 1
+                info = {**info, "last_event_id": event_id}
+                file.truncate(log.end_offset) # Drop a record torn by the crash
+                file.seek(log.end_offset)
+                file.write(_record(EVENT, event_id, json_dumps([event, data])))
+                file.write(_record(FINISH, 0, json_dumps(info)))
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
+            os.close(directory) # Releases the lock
+        log.events.append((event_id, event, data))
+        log.info = {**log.info, **info}
+        log.finished = True
+        return log
+
+    # --- Compaction and retention ---
+    def compact(self, job_id: str):
+        """Rewrite a finished log with only its info, its last `max_events` events and the final info."""
+        path = self.path(job_id)
+        records, _ = read_records(path)
+        info = [record for record in records if record[0] != EVENT]
+        events = [record for record in records if record[0] == EVENT][-self.max_events:]
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(MAGIC)
+            for kind, event_id, payload in info[:1] + events + info[1:]:
+                file.write(_record(kind, event_id, payload))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+    def sweep(self):
+        """Delete logs past their retention, then the oldest ones while over `max_bytes`."""
+        now = time.time()
+        logs = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".log") or entry.name[:-4] in self._writers:
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.retention_seconds:
+                os.unlink(entry.path)
+            else:
+                logs.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in logs)
+        for _, size, path in sorted(logs):
+            if total <= self.max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+            logger.info(f"Deleted job log {path} to stay under {self.max_bytes} bytes.")
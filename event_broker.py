@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import AsyncIterator, Optional
+
+from metrics import DISCONNECTS, EVENTS_DROPPED, QUEUE_DEPTH
+from sse_encoder import encode_event
+
+logger = logging.getLogger(__name__)
+
+
+class SlowConsumerPolicy(str, Enum):
+    """What to do when a subscriber's queue is full."""
+    DROP_OLDEST = "drop_oldest"  # Discard the oldest queued event
+    COALESCE = "coalesce"        # Discard queued 'progress' events, only the latest one matters
+    DISCONNECT = "disconnect"    # Close the subscription
+
+
+@dataclass(frozen=True)
+class BrokerEvent:
+    """An event as published to a topic, with its SSE frame already serialized."""
+    event: str
+    data: dict
+    frame: bytes
+    id: Optional[int] = None
+    created: float = 0.0 # time.perf_counter() when it was published
+
+
+class Subscription:
+    """
+    One subscriber of a topic, with its own bounded queue.
+    Iterate over it to receive events until the topic is closed.
+    """
+
+    def __init__(self, topic: str, maxsize: int, policy: SlowConsumerPolicy):
+        self.topic = topic
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.disconnected = False
+        self._queue: deque[BrokerEvent] = deque()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def offer(self, item: BrokerEvent):
+        """Queue an event, applying the slow-consumer policy if the queue is full."""
+        if self.closed:
+            return
+        if len(self._queue) >= self.maxsize:
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                logger.warning(f"Disconnecting slow subscriber of {self.topic} ({len(self._queue)} events queued).")
+                DISCONNECTS.labels("slow_consumer").inc()
+                self.disconnected = True
+                self.close()
+                return
+            if self.policy == SlowConsumerPolicy.COALESCE and item.event == "progress":
+                # Older progress events are superseded by the new one
+                kept = deque(queued for queued in self._queue if queued.event != "progress")
+                self.dropped += len(self._queue) - len(kept)
+                EVENTS_DROPPED.labels(self.policy.value).inc(len(self._queue) - len(kept))
+                self._queue = kept
+            if len(self._queue) >= self.maxsize:
+                self._queue.popleft()
+                self.dropped += 1
+                EVENTS_DROPPED.labels(self.policy.value).inc()
+        self._queue.append(item)
+        self._wakeup.set()
+
+    def close(self):
+        """Stop the subscription once the queued events have been read."""
+        self.closed = True
+        self._wakeup.set()
+
+    async def __aiter__(self) -> AsyncIterator[BrokerEvent]:
+        while True:
+            while self._queue:
+                yield self._queue.popleft()
+            if self.closed:
+                return
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def batches(self, max_items: int = 64) -> AsyncIterator[list[BrokerEvent]]:
+        """
+        Like iterating over the subscription, but yields every queued event
+        at once (up to `max_items`), so a fast producer costs fewer writes.
+        """
+        while True:
+            while self._queue:
+                QUEUE_DEPTH.observe(len(self._queue))
+                count = min(len(self._queue), max_items)
+                yield [self._queue.popleft() for _ in range(count)]
+            if self.closed:
+                return
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+
+class EventBroker:
+    """
+    In-memory pub/sub for SSE events.
+    Each published event is serialized once and the same frame is handed
+    to every subscriber of the topic through its bounded queue.
+    """
+
+    def __init__(self, queue_size: int = 100, policy: SlowConsumerPolicy = SlowConsumerPolicy.COALESCE):
+        self.queue_size = queue_size
+        self.policy = SlowConsumerPolicy(policy)
+        self._topics: dict[str, set[Subscription]] = {}
+
+    def subscribe(self, topic: str, queue_size: Optional[int] = None,
+                  policy: Optional[SlowConsumerPolicy] = None) -> Subscription:
+        subscription = Subscription(
+            topic,
+            queue_size or self.queue_size,
+            SlowConsumerPolicy(policy) if policy else self.policy,
+        )
+        self._topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.close()
+        subscribers = self._topics.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[subscription.topic]
+
+    def subscriber_count(self, topic: str) -> int:
+        return len(self._topics.get(topic, ()))
+
+    def backlog(self) -> int:
+        """Events published but not yet read, over all subscribers: how far slow sockets are behind."""
+        return sum(len(subscription) for subscribers in self._topics.values() for subscription in subscribers)
+
+    def publish(self, topic: str, event: str, data: dict, event_id: Optional[int] = None) -> BrokerEvent:
+        """Serialize an event and deliver it to every subscriber of the topic."""
+        item = BrokerEvent(event, data, encode_event(data, event, event_id), event_id, time.perf_counter())
+        for subscription in list(self._topics.get(topic, ())):
+            subscription.offer(item)
+            if subscription.disconnected:
+                self.unsubscribe(subscription)
+        return item
+
+    def close_topic(self, topic: str):
+        """End the stream for every subscriber of the topic."""
+        for subscription in self._topics.pop(topic, ()):
+            subscription.close()
@@ -0,0 +1,44 @@
+import logging
+from collections import deque
+from typing import Optional
+
+from event_broker import BrokerEvent
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """
+    Ring buffer of the most recent events of one stream.
+    Event ids increase monotonically, so a client that reconnects with
+    `Last-Event-ID` can be sent only the events it missed.
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self._events: deque[BrokerEvent] = deque(maxlen=maxlen)
+        self.last_id = 0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def next_id(self) -> int:
+        self.last_id += 1
+        return self.last_id
+
+    def append(self, item: BrokerEvent):
+        self._events.append(item)
+
+    def since(self, last_event_id: Optional[int] = None) -> list[BrokerEvent]:
+        """Return the retained events newer than `last_event_id` (all of them if None)."""
+        if last_event_id is None:
+            return list(self._events)
+        if self._events and self._events[0].id > last_event_id + 1:
+            # The ring buffer already dropped some of the events the client missed
+            logger.warning(
+                f"Events {last_event_id + 1} to {self._events[0].id - 1} are no longer in the log; "
+                f"replaying from {self._events[0].id}."
+            )
+        return [item for item in self._events if item.id > last_event_id]
@@ -0,0 +1,260 @@
+import asyncio
+import functools
+import inspect
+import itertools
+import logging
+import threading
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from cancellation import CancellationToken
+from progress_reporter import ProgressReporter
+
+if TYPE_CHECKING:
+    # Imported when a pool is first needed: the process pool pulls in most of multiprocessing
+    from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorKind(str, Enum):
+    """Where a step of a task graph runs."""
+    ASYNC = "async"      # Awaited on the event loop (I/O-bound or already async work)
+    THREAD = "thread"    # Sync function in a thread pool (blocking I/O, C code that releases the GIL)
+    PROCESS = "process"  # Sync function in a process pool (CPU-bound Python code)
+
+
+def _accepts(func: Callable, name: str) -> bool:
+    try:
+        return name in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def accepts_reporter(func: Callable) -> bool:
+    """Steps that want to report progress take a `reporter` keyword argument."""
+    return _accepts(func, "reporter")
+
+
+def accepts_cancel_token(func: Callable) -> bool:
+    """Steps that can stop early take a `cancel_token` keyword argument."""
+    return _accepts(func, "cancel_token")
+
+
+# --- Worker process side ---
+# The queue and the cancellation flags are handed to each worker when the pool
+# starts it, since multiprocessing queues and shared memory cannot be sent along
+# with a task.
+_worker_progress_queue = None
+_worker_cancel_flags = None
+
+
+def _init_worker(progress_queue, cancel_flags):
+    global _worker_progress_queue, _worker_cancel_flags
+    _worker_progress_queue = progress_queue
+    _worker_cancel_flags = cancel_flags
+
+
+class _QueueProgress:
+    """Progress sink used inside worker processes; sends updates back to the server process."""
+
+    def __init__(self, token: int):
+        self.token = token
+
+    def __call__(self, *args):
+        _worker_progress_queue.put((self.token, args))
+
+
+class _SharedFlagToken(CancellationToken):
+    """Cancellation token used inside worker processes; the server process sets its flag in shared memory."""
+
+    def __init__(self, slot: int):
+        super().__init__()
+        self.slot = slot
+
+    @property
+    def cancelled(self) -> bool:
+        return bool(_worker_cancel_flags[self.slot])
+
+
+def _call_in_worker(func: Callable, kwargs: dict, token: Optional[int], cancel_token: Optional[CancellationToken],
+                    wants_cancel_token: bool, min_interval: float, min_delta: float):
+    if token is not None:
+        # The reporter throttles inside the worker, so only the updates that
+        # are passed on have to cross the process boundary.
+        kwargs = {**kwargs, "reporter": ProgressReporter(_QueueProgress(token), min_interval, min_delta, cancel_token)}
+    if wants_cancel_token:
+        kwargs = {**kwargs, "cancel_token": cancel_token}
+    return func(**kwargs)
+
+
+# --- Server process side ---
+class StepExecutors:
+    """
+    Runs step functions inline, in a thread pool or in a process pool.
+    The pools are created the first time they are needed.
+    Steps that take a `reporter` argument get a ProgressReporter throttled with
+    `progress_interval` and `progress_min_delta`. The updates it passes on are
+    always delivered on the event loop, whichever executor the step ran in.
+    Steps that take a `cancel_token` argument get a CancellationToken, which is
+    cancelled when the step is (e.g. because its job was). For process pool steps
+    it reads a flag in shared memory, one of `max_cancellable` slots; a step
+    started while all of them are in use gets a token that never fires.
+    """
+
+    def __init__(self, max_threads: Optional[int] = None, max_processes: Optional[int] = None,
+                 progress_interval: float = 0.25, progress_min_delta: float = 1.0, max_cancellable: int = 1024):
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self.progress_interval = progress_interval
+        self.progress_min_delta = progress_min_delta
+        self._threads: Optional["ThreadPoolExecutor"] = None
+        self._processes: Optional["ProcessPoolExecutor"] = None
+        self._progress_queue = None
+        self._progress_reader: Optional[threading.Thread] = None
+        self._listeners: dict[int, Callable] = {}
+        self._tokens = itertools.count()
+        self.max_cancellable = max_cancellable
+        self._cancel_flags = None
+        self._free_cancel_slots: list[int] = []
+        self._lock = threading.Lock()
+        # Separate from _lock, which shutdown() holds while the pool finishes (and frees slots)
+        self._slots_lock = threading.Lock()
+
+    def _thread_pool(self) -> "ThreadPoolExecutor":
+        with self._lock:
+            if self._threads is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._threads = ThreadPoolExecutor(self.max_threads, thread_name_prefix="step")
+            return self._threads
+
+    def _process_pool(self) -> "ProcessPoolExecutor":
+        with self._lock:
+            if self._processes is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                self._progress_queue = multiprocessing.Queue()
+                self._cancel_flags = multiprocessing.Array("b", self.max_cancellable, lock=False)
+                self._free_cancel_slots = list(range(self.max_cancellable))
+                self._processes = ProcessPoolExecutor(
+                    self.max_processes, initializer=_init_worker,
+                    initargs=(self._progress_queue, self._cancel_flags),
+                )
+                self._progress_reader = threading.Thread(
+                    target=self._read_progress, name="step-progress-reader", daemon=True
+                )
+                self._progress_reader.start()
+            return self._processes
+
+    def _read_progress(self):
+        """Forwards progress updates from worker processes to the step that is waiting for them."""
+        while True:
+            item = self._progress_queue.get()
+            if item is None:
+                return
+            token, args = item
+            listener = self._listeners.get(token)
+            if listener is not None:
+                listener(*args)
+
+    async def run(self, kind: ExecutorKind, func: Callable, kwargs: dict,
+                  on_progress: Optional[Callable[..., None]] = None) -> Any:
+        """
+        Run `func(**kwargs)` in the given executor and return its result.
+        `on_progress(done, total)` receives the updates of the step's reporter.
+        If the caller is cancelled, so is the step's cancel_token: a thread or
+        process that is already running the step keeps going until it checks it.
+        """
+        kind = ExecutorKind(kind)
+        wants_reporter = on_progress is not None and accepts_reporter(func)
+        cancel_token = CancellationToken()
+        if accepts_cancel_token(func) and kind != ExecutorKind.PROCESS:
+            kwargs = {**kwargs, "cancel_token": cancel_token}
+        try:
+            if kind == ExecutorKind.ASYNC:
+                if wants_reporter:
+                    kwargs = {**kwargs, "reporter": self._reporter(on_progress, cancel_token)}
+                return await func(**kwargs)
+
+            loop = asyncio.get_running_loop()
+
+            def progress_from_thread(*args):
+                loop.call_soon_threadsafe(on_progress, *args)
+
+            if kind == ExecutorKind.THREAD:
+                if wants_reporter:
+                    kwargs = {**kwargs, "reporter": self._reporter(progress_from_thread, cancel_token)}
+                return await loop.run_in_executor(self._thread_pool(), functools.partial(func, **kwargs))
+
+            return await self._run_in_process(func, kwargs, progress_from_thread if wants_reporter else None)
+        except asyncio.CancelledError:
+            cancel_token.cancel()
+            raise
+
+    async def _run_in_process(self, func: Callable, kwargs: dict, on_progress: Optional[Callable[..., None]]) -> Any:
+        pool = self._process_pool()
+        wants_cancel_token = accepts_cancel_token(func)
+        token = None
+        if on_progress is not None:
+            token = next(self._tokens)
+            self._listeners[token] = on_progress
+        slot = cancel_token = None
+        if wants_cancel_token or on_progress is not None: # The reporter checks the token too
+            slot = self._take_cancel_slot()
+            cancel_token = _SharedFlagToken(slot) if slot is not None else CancellationToken()
+        future = pool.submit(
+            _call_in_worker, func, kwargs, token, cancel_token, wants_cancel_token,
+            self.progress_interval, self.progress_min_delta,
+        )
+        if slot is not None:
+            # Only reused once the worker is done with it, which can be after we stopped waiting
+            future.add_done_callback(lambda _: self._free_cancel_slot(slot))
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if slot is not None:
+                self._raise_cancel_flag(slot, future)
+            raise
+        finally:
+            if token is not None:
+                self._listeners.pop(token, None)
+
+    def _take_cancel_slot(self) -> Optional[int]:
+        with self._slots_lock:
+            if not self._free_cancel_slots:
+                logger.warning(f"All {self.max_cancellable} cancellation slots are in use; "
+                               f"this step cannot be cancelled while it runs.")
+                return None
+            return self._free_cancel_slots.pop()
+
+    def _raise_cancel_flag(self, slot: int, future: "Future"):
+        with self._slots_lock:
+            # A step cancelled while queued is done already and its slot freed (maybe reused)
+            if self._cancel_flags is not None and not future.done():
+                self._cancel_flags[slot] = 1
+
+    def _free_cancel_slot(self, slot: int):
+        # Called from the pool's management thread
+        with self._slots_lock:
+            if self._cancel_flags is not None:
+                self._cancel_flags[slot] = 0
+                self._free_cancel_slots.append(slot)
+
+    def _reporter(self, sink: Callable[[int, int], None], cancel_token: CancellationToken) -> ProgressReporter:
+        return ProgressReporter(sink, self.progress_interval, self.progress_min_delta, cancel_token)
+
+    def shutdown(self):
+        """Stop the pools and the progress reader (pending work is cancelled)."""
+        with self._lock:
+            if self._threads is not None:
+                self._threads.shutdown(wait=False, cancel_futures=True)
+                self._threads = None
+            if self._processes is not None:
+                self._processes.shutdown(wait=True, cancel_futures=True)
+                self._processes = None
+                self._progress_queue.put(None)
+                self._progress_reader.join(timeout=5)
+                self._progress_queue = None
+                self._progress_reader = None
+                self._cancel_flags = None
+        logger.info("Step executors shut down.")
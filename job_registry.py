@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Optional
+
+from event_broker import BrokerEvent, EventBroker
+from event_log import EventLog
+from metrics import JOBS_DEDUPLICATED, JOBS_FINISHED, JOBS_STARTED
+
+if TYPE_CHECKING:
+    # Both are optional; main_progress only imports them when they are configured
+    from backplane import Backplane
+    from durable_log import JobLogStore
+
+logger = logging.getLogger(__name__)
+
+# Job states that mean the task is no longer running
+FINISHED_STATES = ("completed", "failed", "cancelled")
+
+
+class Job:
+    """
+    A single background run of the task pipeline.
+    The task publishes events here, and any number of SSE subscribers
+    can read them, whether they attach at the start or part way through.
+    """
+
+    def __init__(self, job_id: str, broker: EventBroker, event_log_size: int = 1000, key: Optional[str] = None,
+                 sinks: tuple = ()):
+        self.id = job_id
+        self.key = key
+        self.status = "pending"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+        # Counts the job against the client that started it while it runs (see admission.py)
+        self.admission_ticket = None
+        # When someone last followed the job (see JobRegistry.abandon_after)
+        self.last_followed = time.monotonic()
+        self.events = EventLog(event_log_size)
+        self._broker = broker
+        # Where events are copied besides the local subscribers (backplane, on-disk log);
+        # each has announce(), publish() and finish() methods
+        self._sinks = sinks
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def publish(self, event: str, data: dict):
+        """Record an event and fan it out to every live subscriber."""
+        event_id = self.events.next_id()
+        self.events.append(self._broker.publish(self.id, event, data, event_id))
+        for sink in self._sinks:
+            sink.publish(self.id, event_id, event, data)
+
+    def cancel(self, reason: str) -> bool:
+        """
+        Stop the job's task; subscribers get a 'cancelled' event with the `reason`.
+        Its steps are cancelled too (see CancellationToken). Returns False if it already finished.
+        """
+        if self.done or self.task is None:
+            return False
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+        self.task.cancel()
+        return True
+
+    def finish(self, status: str):
+        """Mark the job as finished so subscribers stop waiting for more events."""
+        self.status = status
+        self.finished_at = time.time()
+        self._broker.close_topic(self.id)
+        for sink in self._sinks:
+            sink.finish(self.id, self.to_dict())
+        JOBS_FINISHED.labels(status).inc()
+
+    async def subscribe(self, last_event_id: Optional[int] = None,
+                        max_batch: int = 64) -> AsyncIterator[list[BrokerEvent]]:
+        """
+        Yield the events of the job after `last_event_id` (from the first
+        retained one if None), then keep yielding live events until the job finishes.
+        Events come in batches of up to `max_batch` when several are ready at once.
+        """
+        # Taking the history and subscribing happen without an await in
+        # between, so no event can be missed or delivered twice.
+        history = self.events.since(last_event_id)
+        subscription = None if self.done else self._broker.subscribe(self.id)
+        try:
+            for start in range(0, len(history), max_batch):
+                yield history[start:start + max_batch]
+            if subscription is None:
+                return
+            async for batch in subscription.batches(max_batch):
+                yield batch
+            if subscription.disconnected:
+                logger.warning(f"Subscriber of job {self.id} was too slow and got disconnected.")
+        finally:
+            if subscription is not None:
+                self._broker.unsubscribe(subscription)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "last_event_id": self.events.last_id,
+        }
+
+
+class RemoteJob(Job):
+    """
+    A job running in another server process, followed through the backplane.
+    Its events are replayed into a local log and broker, so the subscribers
+    in this process read it like any other job.
+    """
+
+    def update(self, info: dict):
+        status = info.get("status", self.status)
+        # Info can be older than the events already received: never go back to pending once running
+        if status != "pending" or self.status == "pending":
+            self.status = status
+        self.created_at = info.get("created_at", self.created_at)
+        self.finished_at = info.get("finished_at", self.finished_at)
+        self.key = info.get("key", self.key) # Announced with it, so it is known to be shared
+
+    def receive(self, event_id: int, event: str, data):
+        # Ids come from the owner, so Last-Event-ID works across processes
+        self.events.last_id = event_id
+        if self.status == "pending":
+            self.status = "running" # It was announced before it started
+
+        self.events.append(self._broker.publish(self.id, event, data, event_id))
+
+    def finish_remote(self, info: dict):
+        self.update(info)
+        self._broker.close_topic(self.id)
+
+
+class RecoveredJob(RemoteJob):
+    """A job from before a restart, replayed from its on-disk log."""
+
+
+class JobRegistry:
+    """
+    Keeps track of running and recently finished jobs by id.
+    Jobs run as asyncio tasks, so they keep going when a client disconnects.
+    With a `backplane`, jobs started in other server processes can be found too,
+    and with a `store`, jobs from before a restart.
+    With `abandon_after`, a running job that nobody followed for that many seconds
+    (no subscriber in any process) is cancelled, so it stops using the CPU.
+    """
+
+    def __init__(self, broker: Optional[EventBroker] = None, retention_seconds: float = 300.0,
+                 event_log_size: int = 1000, backplane: Optional["Backplane"] = None,
+                 store: Optional["JobLogStore"] = None, abandon_after: Optional[float] = None):
+        self.broker = broker or EventBroker()
+        # How many recent events per job are kept for Last-Event-ID replay
+        self.event_log_size = event_log_size
+        # How long a finished job stays available for late subscribers
+        self.retention_seconds = retention_seconds
+        self._jobs: dict[str, Job] = {}
+        # Running jobs by key, so identical requests share one run
+        self._running_by_key: dict[str, Job] = {}
+        self.backplane = backplane
+        self.store = store
+        self._sinks = tuple(sink for sink in (store, backplane) if sink is not None)
+        self._remote_lookups: dict[str, asyncio.Task] = {}
+        self.abandon_after = abandon_after
+        self._watchdog: Optional[asyncio.Task] = None
+        if backplane is not None:
+            backplane.on_connect = self._announce_all
+            backplane.on_cancel = self._cancel_here
+
+    def start(self, runner: Callable[[Job], Awaitable[None]], key: Optional[str] = None) -> Job:
+        """
+        Create a job and start `runner(job)` in the background.
+        If a job with the same `key` is still running, that job is returned
+        instead, so concurrent identical requests attach to one computation.
+        """
+        if key is not None:
+            running = self._running_by_key.get(key)
+            if running is not None and not running.done:
+                JOBS_DEDUPLICATED.inc()
+                logger.info(f"Attaching to running job {running.id} for the same request")
+                return running
+        job = Job(uuid.uuid4().hex, self.broker, self.event_log_size, key, self._sinks)
+        self._jobs[job.id] = job
+        if key is not None:
+            self._running_by_key[key] = job
+        for sink in self._sinks:
+            sink.announce(job.id, {**job.to_dict(), "key": key})
+        job.task = asyncio.create_task(self._run(job, runner))
+        self._start_watchdog()
+        JOBS_STARTED.inc()
+        logger.info(f"Started job {job.id}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def find(self, job_id: str) -> Optional[Job]:
+        """
+        Like get(), but also looks for the job in other processes through the
+        backplane, and then in the on-disk logs of jobs from before a restart.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None or (self.backplane is None and self.store is None):
+            return job
+        # Concurrent requests for the same job share one lookup
+        lookup = self._remote_lookups.get(job_id)
+        if lookup is None:
+            lookup = self._remote_lookups[job_id] = asyncio.create_task(self._find_elsewhere(job_id))
+            lookup.add_done_callback(lambda _: self._remote_lookups.pop(job_id, None))
+        return await asyncio.shield(lookup)
+
+    async def _find_elsewhere(self, job_id: str) -> Optional[Job]:
+        job = None
+        if self.backplane is not None:
+            job = await self._attach_remote(job_id)
+        if job is None and self.store is not None:
+            job = await self._recover(job_id)
+        return job
+
+    async def _recover(self, job_id: str) -> Optional[Job]:
+        """Replays a job from its on-disk log."""
+        log = await asyncio.to_thread(self.store.load, job_id)
+        if log is not None and not log.finished:
+            # Either its process stopped before the job finished, so it never will, or it is
+            # still running in a process we cannot see: then the store returns None (not found)
+            log = await asyncio.to_thread(
+                self.store.finish_interrupted, job_id, "error",
+                {"error": "The server restarted while this job was running."},
+                {"status": "failed", "finished_at": time.time()},
+            )
+        if log is None:
+            return None
+        job = RecoveredJob(job_id, self.broker, self.event_log_size, log.info.get("key"))
+        job.update(log.info)
+        for event_id, event, data in log.events:
+            job.receive(event_id, event, data)
+        job.finish_remote(job.to_dict())
+        self._jobs[job_id] = job
+        self._forget_later(job)
+        logger.info(f"Recovered job {job_id} ({job.status}, {len(log.events)} events) from its log")
+        return job
+
+    async def _attach_remote(self, job_id: str) -> Optional[Job]:
+        job = RemoteJob(job_id, self.broker, self.event_log_size)
+
+        def on_finish(info: dict):
+            job.finish_remote(info)
+            self.backplane.unsubscribe(job_id)
+            self._forget_later(job)
+
+        info = await self.backplane.subscribe(job_id, job.receive, on_finish)
+        if info is None:
+            return None
+        if not job.done:
+            job.update(info)
+        self._jobs[job_id] = job
+        self._start_watchdog()
+        logger.info(f"Following job {job_id} from another process")
+        return job
+
+    async def cancel(self, job_id: str, reason: str = "Cancelled by a client.") -> Optional[Job]:
+        """
+        Cancel a running job, also when it runs in another process.
+        Returns the job, or None if it is unknown. Cancelling a finished job does nothing.
+        """
+        job = await self.find(job_id)
+        if job is None or job.done:
+            return job
+        if isinstance(job, RemoteJob):
+            self.backplane.cancel(job_id, reason)
+        else:
+            job.cancel(reason)
+        logger.info(f"Cancelling job {job_id}: {reason}")
+        return job
+
+    def _cancel_here(self, job_id: str, reason: str):
+        # Another process asked, through the backplane
+        job = self._jobs.get(job_id)
+        if job is not None and not isinstance(job, RemoteJob):
+            job.cancel(reason)
+
+    def _followers(self, job: Job) -> int:
+        count = self.broker.subscriber_count(job.id)
+        if self.backplane is not None and not isinstance(job, RemoteJob):
+            count += self.backplane.followers(job.id)
+        return count
+
+    async def close(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _start_watchdog(self):
+        if self.abandon_after is not None and self._watchdog is None:
+            self._watchdog = asyncio.create_task(self._cancel_abandoned())
+
+    async def _cancel_abandoned(self):
+        """Cancels the running jobs that nobody followed for `abandon_after` seconds."""
+        while True:
+            await asyncio.sleep(self.abandon_after / 4)
+            now = time.monotonic()
+            for job in list(self._jobs.values()):
+                if job.done:
+                    continue
+                if self._followers(job):
+                    job.last_followed = now
+                elif now - job.last_followed >= self.abandon_after:
+                    if isinstance(job, RemoteJob):
+                        # Stop following it, so the process running it sees nobody here follows it any more
+                        self.backplane.unsubscribe(job.id)
+                        self.broker.close_topic(job.id)
+                        self._jobs.pop(job.id, None)
+                    else:
+                        job.cancel(f"Nobody followed this job for {self.abandon_after:g} seconds.")
+
+    def _announce_all(self):
+        """Re-sends the jobs running here, e.g. to a backplane hub that took over after a restart."""
+        for job in list(self._jobs.values()):
+            if isinstance(job, RemoteJob):
+                continue
+            self.backplane.announce(job.id, job.to_dict())
+            for item in job.events:
+                self.backplane.publish(job.id, item.id, item.event, item.data)
+            if job.done:
+                self.backplane.finish(job.id, job.to_dict())
+
+    def _forget_later(self, job: Job):
+        # Forget the job once late subscribers have had a chance to read it
+        asyncio.get_running_loop().call_later(self.retention_seconds, self._jobs.pop, job.id, None)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def _run(self, job: Job, runner: Callable[[Job], Awaitable[None]]):
+        job.status = "running"
+        if self.backplane is not None:
+            # It was announced as pending; processes that look it up from now on should see it running
+            self.backplane.announce(job.id, {**job.to_dict(), "key": job.key})
+        try:
+            await runner(job)
+        except asyncio.CancelledError:
+            reason = job.cancel_reason or "The job was cancelled."
+            logger.warning(f"Job {job.id} was cancelled: {reason}")
+            job.publish("cancelled", {"reason": reason})
+            job.finish("cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}", exc_info=True)
+            error_payload = {"error": "An unexpected server error occurred.", "details": str(e)}
+            job.publish("error", error_payload)
+            job.finish("failed")
+        else:
+            job.finish("completed")
+            logger.info(f"Job {job.id} completed.")
+        finally:
+            if job.key is not None and self._running_by_key.get(job.key) is job:
+                del self._running_by_key[job.key]
+            self._forget_later(job)
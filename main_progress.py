@@ -1,222 +1,662 @@
 import asyncio
-import json
-import uvicorn
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, HTMLResponse
+import functools
+import os
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from typing import Optional
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from admission import AdmissionController, Rejected, Ticket
+from event_broker import EventBroker, SlowConsumerPolicy
+from job_registry import Job, JobRegistry
+from sse_encoder import encode_event, join_frames
+from executors import StepExecutors
+from metrics import (
+    ACTIVE_STREAMS, BYTES_SENT, DISCONNECTS, EVENTS_SENT, FLUSH_LATENCY, HEARTBEATS_SENT, REGISTRY,
+    RESULT_CACHE_LOOKUPS, SampledLogger,
+)
+from progress_reporter import ProgressReporter
+from result_cache import ResultCache, make_cache_key
+from stream_encoding import DeltaEncoder, compress_stream, negotiate, response_headers
+from task_graph import Step, TaskGraph, run_graph
+
+# Logging is configured by create_app(), not by importing this module
 logger = logging.getLogger(__name__)
+# Per-event messages: debug level, and only a sample of them
+event_log = SampledLogger(logger, every=100)
+
+# --- Executors for steps that do not run on the event loop ---
+# Steps declared with executor="thread" or "process" run here, so CPU-bound
+# work does not block the other SSE streams. None means one per CPU core.
+MAX_WORKER_THREADS = None
+MAX_WORKER_PROCESSES = None
+# In-step progress is passed on at most every PROGRESS_MIN_INTERVAL seconds,
+# and only when it moved by at least PROGRESS_MIN_DELTA percent
+PROGRESS_MIN_INTERVAL = 0.25
+PROGRESS_MIN_DELTA = 1.0
+step_executors = StepExecutors(MAX_WORKER_THREADS, MAX_WORKER_PROCESSES, PROGRESS_MIN_INTERVAL, PROGRESS_MIN_DELTA)
+
+
+# --- Sharing jobs between worker processes ---
+# With `uvicorn main_progress:app --workers N`, set BACKPLANE_SOCKET to a path
+# (e.g. /tmp/sse-progress.sock) so a client can follow its job from any worker.
+# Unset, every process only knows the jobs it started itself.
+BACKPLANE_SOCKET = os.environ.get("BACKPLANE_SOCKET")
+
+# --- On-disk job logs ---
+# Set JOB_LOG_DIR (e.g. ./job-logs) to keep an append-only log per job, so clients
+# can still replay a job's events, including its result, after the server restarts.
+# Unset, the history of a job only lives in memory.
+JOB_LOG_DIR = os.environ.get("JOB_LOG_DIR")
+JOB_LOG_FSYNC_INTERVAL = 1.0  # New events are fsynced together this often
+JOB_LOG_RETENTION_SECONDS = 7 * 24 * 3600  # Logs are deleted this long after their last write
+JOB_LOG_MAX_BYTES = 1024 ** 3  # The oldest logs are deleted beyond this total size
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if backplane is not None:
+        await backplane.start()
+    if job_log_store is not None:
+        await job_log_store.start()
+    yield
+    await job_registry.close()
+    if job_log_store is not None:
+        await job_log_store.close()
+    if backplane is not None:
+        await backplane.close()
+    step_executors.shutdown()
+
+
+class Routes:
+    """
+    Collects the endpoints of this module through decorators, like an APIRouter,
+    but only adds them to the app in create_app(): FastAPI analyses each endpoint's
+    signature when its route is built, the slowest part of setting up the app.
+    """
+
+    def __init__(self):
+        self._routes: list[tuple[str, str, dict]] = []
+
+    def _route(self, method: str, path: str, **kwargs):
+        def register(endpoint):
+            self._routes.append((method, path, {"endpoint": endpoint, **kwargs}))
+            return endpoint
+        return register
+
+    def get(self, path: str, **kwargs):
+        return self._route("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self._route("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self._route("DELETE", path, **kwargs)
+
+    def include_in(self, app: FastAPI):
+        for method, path, kwargs in self._routes:
+            app.add_api_route(path, methods=[method], **kwargs)
+
+
+routes = Routes()
+
+# --- Fan-out settings for subscribers of a job ---
+SUBSCRIBER_QUEUE_SIZE = 100  # Events buffered per subscriber before the policy applies
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy.COALESCE  # Or DROP_OLDEST / DISCONNECT
+EVENT_LOG_SIZE = 1000  # Recent events kept per job for Last-Event-ID replay
+RECONNECT_RETRY_MS = 3000  # Sent as the SSE retry: field
+MAX_JOBS_PER_STREAM = 100  # Jobs that one /stream-jobs connection can follow
+# A running job that no client follows for this long is cancelled (None: jobs always run to the end).
+# Clients that start a job with POST /jobs have this long to subscribe to it.
+ABANDONED_JOB_GRACE_SECONDS = 30
+
+# --- Keep-alive settings for SSE connections ---
+HEARTBEAT_SECONDS = 15  # A comment frame is sent this often, so proxies keep the connection open
+SEND_TIMEOUT_SECONDS = 30  # A write stuck longer than this means a dead (half-open) client
+# zlib level for streams that ask for compression (?compress=gzip); higher costs more CPU per event
+STREAM_COMPRESSION_LEVEL = 6
+
+# --- Result cache for identical task runs ---
+RESULT_CACHE_TTL_SECONDS = 300  # How long a finished result is replayed instead of recomputed
+RESULT_CACHE_MAX_ENTRIES = 128  # Least recently used results are evicted beyond this
+result_cache = ResultCache(RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_ENTRIES)
+
+# --- Admission control ---
+# Over these limits a request gets 429 (its client is over its own limits) or
+# 503 (the server is full) with a Retry-After header, instead of waiting in line.
+# Clients are told apart by address: behind a reverse proxy, run uvicorn with
+# --proxy-headers so that is the real client's. ADMISSION_CONTROL=off disables it.
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "on") != "off"
+# A caller that makes requests for many users, like the Streamlit server, can name
+# the user in the CLIENT_ID_HEADER header, so each gets limits of its own. It is only
+# believed from these addresses (comma-separated), or anyone could pick a fresh id per request.
+CLIENT_ID_HEADER = "X-Client-Id"
+CLIENT_ID_TRUSTED_ADDRESSES = frozenset(os.environ.get("CLIENT_ID_TRUSTED_ADDRESSES", "127.0.0.1,::1").split(","))
+MAX_CLIENT_ID_LENGTH = 64
+MAX_STREAMS = 10_000  # Open SSE streams in total
+MAX_STREAMS_PER_CLIENT = 50
+STREAM_OPENS_PER_SECOND = 5.0  # Per client, on average; bursts of STREAM_OPEN_BURST are fine
+STREAM_OPEN_BURST = 20
+MAX_RUNNING_JOBS = 100  # Jobs running at the same time in total
+MAX_RUNNING_JOBS_PER_CLIENT = 5
+JOB_STARTS_PER_SECOND = 0.5  # Per client, on average; bursts of JOB_START_BURST are fine
+JOB_START_BURST = 5
+# Events waiting for slow sockets in all subscriber queues; beyond this no new
+# jobs are started, so slow readers hold back producers instead of filling memory
+MAX_QUEUED_EVENTS = 100_000
+BUSY_RETRY_AFTER_SECONDS = 5  # Retry-After when a cap on open streams or running jobs is reached
+admission = AdmissionController(
+    MAX_STREAMS, MAX_STREAMS_PER_CLIENT, STREAM_OPENS_PER_SECOND, STREAM_OPEN_BURST,
+    MAX_RUNNING_JOBS, MAX_RUNNING_JOBS_PER_CLIENT, JOB_STARTS_PER_SECOND, JOB_START_BURST,
+    MAX_QUEUED_EVENTS, BUSY_RETRY_AFTER_SECONDS, enabled=ADMISSION_CONTROL,
+)
+
+# Running and recently finished jobs, shared by every subscriber.
+# The registry, and the backplane and job log store it uses when they are configured, are set up by create_app()
+event_broker = EventBroker(SUBSCRIBER_QUEUE_SIZE, SLOW_CONSUMER_POLICY)
+backplane = None
+job_log_store = None
+job_registry: Optional[JobRegistry] = None
+
+# The page with the progress bar, read on the first request for it
+INDEX_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html")
+
+
+@functools.cache
+def index_page() -> bytes:
+    with open(INDEX_PAGE, "rb") as file:
+        return file.read()
+
 
-app = FastAPI()
-
-# HTML for progress bar (remains the same as your example)
-html = """
-<!DOCTYPE html>
-<html>
-    <head>
-        <title>SSE Progress Example</title>
-        <style>
-            /* Optional: make progress bar more visible */
-            progress {
-                width: 100%;
-                height: 25px;
-            }
-        </style>
-    </head>
-    <body>
-        <h1>Sequential Task Progress</h1>
-        <progress id="progress-bar" value="0" max="100"></progress>
-        <div id="status">Status: Waiting to start...</div>
-        <div id="result">Result: Not finished</div>
-        <script>
-            const progressBar = document.getElementById('progress-bar');
-            const statusElement = document.getElementById('status');
-            const resultElement = document.getElementById('result');
-
-            console.log("Initializing EventSource for /stream-progress");
-            const eventSource = new EventSource('/stream-progress');
-
-            // Listener for 'progress' updates
-            eventSource.addEventListener('progress', function(event) {
-                try {
-                    const data = JSON.parse(event.data);
-                    progressBar.value = data.percent;
-                    statusElement.textContent = `Status: ${data.message} (${data.percent}%)`;
-                    console.log("Progress update:", data);
-                } catch (e) {
-                    console.error("Error parsing progress data:", e, event.data);
-                    statusElement.textContent = "Status: Error parsing update.";
-                }
-            });
-
-            // Listener for the 'complete' event
-            eventSource.addEventListener('complete', function(event) {
-                 try {
-                    const data = JSON.parse(event.data);
-                    progressBar.value = 100; // Ensure progress bar is full
-                    statusElement.textContent = "Status: Task Completed!";
-                    resultElement.textContent = `Result: ${data.result}`;
-                    console.log("Task complete:", data);
-                    eventSource.close(); // Close the connection once task is done
-                    console.log("SSE connection closed by client upon completion.");
-                } catch (e) {
-                    console.error("Error parsing complete data:", e, event.data);
-                    statusElement.textContent = "Status: Error parsing completion update.";
-                    eventSource.close();
-                }
-            });
-
-            eventSource.onerror = function(error) {
-                statusElement.textContent = "Status: Error connecting (see console)";
-                console.error("EventSource failed:", error, "State:", eventSource.readyState);
-                // Don't close here if you want browser's auto-reconnect to try
-                if (eventSource.readyState === EventSource.CLOSED) {
-                    console.log("SSE connection definitely closed.");
-                } else {
-                    console.log("SSE error, browser might attempt to reconnect.");
-                }
-            };
-
-            eventSource.onopen = function() {
-                statusElement.textContent = "Status: Connected, task starting...";
-                console.log("Connection to SSE stream opened.");
-                 progressBar.value = 0; // Reset progress on open
-                 resultElement.textContent = "Result: Not finished";
-            };
-
-            window.onbeforeunload = function() {
-                if (eventSource && eventSource.readyState !== EventSource.CLOSED) {
-                    eventSource.close();
-                    console.log("SSE Connection closed by window unload.");
-                }
-            };
-        </script>
-    </body>
-</html>
-"""
-
-@app.get("/")
+@routes.get("/")
 async def get_index_page():
     """Serve the HTML page for the SSE client."""
-    return HTMLResponse(content=html)
+    return HTMLResponse(content=index_page())
 
 # --- Worker Functions (They just do work, no SSE yielding) ---
-async def sum_operation():
+async def simulate_work(seconds: float, reporter: ProgressReporter, chunks: int = 20):
+    """Sleeps in small chunks, reporting progress after each one."""
+    for i in range(chunks):
+        await asyncio.sleep(seconds / chunks)
+        reporter.update(i + 1, chunks) # Throttled, so calling it often is fine
+
+async def sum_operation(reporter: ProgressReporter):
     """Simulates the 'sum' part of the task."""
     logger.info("Starting sum_operation...")
-    await asyncio.sleep(2) # Simulate work for 2 seconds
+    await simulate_work(2, reporter) # Simulate work for 2 seconds
     logger.info("sum_operation finished.")
     return "Sum operation successful"
 
-async def multiply_operation():
+async def multiply_operation(reporter: ProgressReporter):
     """Simulates the 'multiply' part of the task."""
     logger.info("Starting multiply_operation...")
-    await asyncio.sleep(3) # Simulate work for 3 seconds
+    await simulate_work(3, reporter) # Simulate work for 3 seconds
     logger.info("multiply_operation finished.")
     return "Multiply operation successful"
 
-async def divide_operation():
+async def divide_operation(reporter: ProgressReporter):
     """Simulates the 'divide' part of the task."""
     logger.info("Starting divide_operation...")
-    await asyncio.sleep(1.5) # Simulate work for 1.5 seconds
+    await simulate_work(1.5, reporter) # Simulate work for 1.5 seconds
     logger.info("divide_operation finished.")
     return "Divide operation successful"
 
-# --- The Main SSE Generator ---
-async def main_task_sse_generator(request: Request):
+# --- The Task Pipeline (runs in the background as a job) ---
+# Each step declares what it depends on and its expected cost (here, its usual
+# duration in seconds), which weights the progress percentage. Steps without
+# dependencies between them run concurrently.
+# A real CPU-bound computation would be a plain function declared with
+# executor="process", e.g. Step("fit", fit_model, cost=30, executor="process").
+# Such a function cannot be interrupted from the outside: to stop when its job is
+# cancelled, it takes a `cancel_token` argument and calls cancel_token.raise_if_cancelled()
+# now and then (reporter.update() does that too).
+PIPELINE = TaskGraph([
+    Step("sum", sum_operation, cost=2),
+    Step("multiply", multiply_operation, cost=3),
+    Step("divide", divide_operation, cost=1.5),
+])
+MAX_CONCURRENT_STEPS = 4  # Upper bound on steps of one job running at the same time
+
+
+async def run_main_task(job: Job):
     """
-    Main generator that orchestrates tasks and sends SSE progress updates.
+    Runs the pipeline for a job and publishes a progress event as each step finishes.
+    Subscribers read these events through /stream-progress/{job_id}.
+    The completion data is cached under the job's key for later identical requests.
     """
-    logger.info("Client connected. Starting main task sequence.")
-    total_tasks = 3 # We have sum, multiply, divide
+    logger.info(f"Job {job.id}: starting task pipeline.")
 
-    try:
-        # --- Task 1: Sum ---
-        if await request.is_disconnected():
-            logger.warning("Client disconnected before sum_operation.")
-            return # Stop generating if client disconnected
-
-        sum_result = await sum_operation()
-        progress_data_sum = {
-            "percent": int(1/total_tasks * 100),
-            "message": f"Sum Operation Complete. Status: {sum_result}"
+    def on_step_done(step: Step, result, percent: int):
+        progress_data = {
+            "percent": percent,
+            "step": step.name,
+            "message": f"{step.name.capitalize()} Operation Complete. Status: {result}"
         }
-        yield f"event: progress\ndata: {json.dumps(progress_data_sum)}\n\n"
-        logger.info(f"Sent progress after sum: {progress_data_sum}")
+        job.publish("progress", progress_data)
+        event_log.debug("Job %s: progress after %s: %s", job.id, step.name, progress_data)
 
+    def on_step_progress(step: Step, done, total, percent: int):
+        # Progress reported from inside a step, possibly from a worker process
+        job.publish("progress", {
+            "percent": percent,
+            "step": step.name,
+            "message": f"{step.name.capitalize()} Operation: {done}/{total}"
+        })
 
-        # --- Task 2: Multiply ---
-        if await request.is_disconnected():
-            logger.warning("Client disconnected before multiply_operation.")
-            return
+    results = await run_graph(
+        PIPELINE,
+        on_step_done,
+        max_concurrency=MAX_CONCURRENT_STEPS,
+        executors=step_executors,
+        on_step_progress=on_step_progress,
+    )
 
-        multiply_result = await multiply_operation()
-        progress_data_multiply = {
-            "percent": int(2/total_tasks * 100),
-            "message": f"Multiply Operation Complete. Status: {multiply_result}"
-        }
-        yield f"event: progress\ndata: {json.dumps(progress_data_multiply)}\n\n"
-        logger.info(f"Sent progress after multiply: {progress_data_multiply}")
+    # --- All Tasks Complete ---
+    completion_data = {
+        "result": "All operations (Sum, Multiply, Divide) completed successfully!",
+        "summary": results
+    }
+    job.publish("complete", completion_data)
+    logger.info(f"Job {job.id}: published final completion message.")
+    if job.key is not None:
+        result_cache.put(job.key, completion_data)
 
 
-        # --- Task 3: Divide ---
-        if await request.is_disconnected():
-            logger.warning("Client disconnected before divide_operation.")
-            return
+async def replay_cached_result(job: Job, completion_data: dict):
+    """Streams a cached result right away, ending with the same 'complete' event."""
+    job.publish("progress", {"percent": 100, "message": "Result served from cache."})
+    job.publish("complete", {**completion_data, "cached": True})
 
-        divide_result = await divide_operation()
-        progress_data_divide = {
-            "percent": int(3/total_tasks * 100), # Should be 100%
-            "message": f"Divide Operation Complete. Status: {divide_result}"
-        }
-        yield f"event: progress\ndata: {json.dumps(progress_data_divide)}\n\n"
-        logger.info(f"Sent progress after divide: {progress_data_divide}")
-
-
-        # --- All Tasks Complete ---
-        if await request.is_disconnected():
-            logger.warning("Client disconnected just before sending completion.")
-            return
-
-        completion_data = {
-            "result": "All operations (Sum, Multiply, Divide) completed successfully!",
-            "summary": {
-                "sum": sum_result,
-                "multiply": multiply_result,
-                "divide": divide_result
-            }
-        }
-        yield f"event: complete\ndata: {json.dumps(completion_data)}\n\n"
-        logger.info("Sent final completion message.")
+
+def start_main_task(refresh: bool = False, share: bool = True) -> Job:
+    """
+    Starts a job for the task pipeline, unless it can be avoided:
+    a cached result is replayed, and an identical running job is shared.
+    `refresh` skips the cache (but still shares a running job).
+    Without `share`, the job is the caller's own: never shared, and its result is not cached.
+    """
+    if not share:
+        RESULT_CACHE_LOOKUPS.labels("bypass").inc()
+        return job_registry.start(run_main_task)
+    # The pipeline has no inputs yet; they would go into the params here
+    key = make_cache_key("main_task", {})
+    cached = None if refresh else result_cache.get(key)
+    if cached is not None:
+        RESULT_CACHE_LOOKUPS.labels("hit").inc()
+        return job_registry.start(lambda job: replay_cached_result(job, cached))
+    RESULT_CACHE_LOOKUPS.labels("bypass" if refresh else "miss").inc()
+    return job_registry.start(run_main_task, key=key)
+
+
+def client_id(request: Request) -> str:
+    """Who admission control counts a request against: the client's address, or the id a trusted caller sent."""
+    address = request.client.host if request.client else "unknown"
+    named = request.headers.get(CLIENT_ID_HEADER)
+    if named and address in CLIENT_ID_TRUSTED_ADDRESSES:
+        return f"{address}/{named[:MAX_CLIENT_ID_LENGTH]}"
+    return address
+
+
+def admit_stream(request: Request) -> Ticket:
+    """Admit a new stream for the client of `request`, or fail fast with 429/503."""
+    try:
+        return admission.admit_stream(client_id(request))
+    except Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
+
+def admit_main_task(request: Request, refresh: bool = False, share: bool = True) -> Job:
+    """start_main_task() for the client of `request`, within its limits (or fail fast with 429/503)."""
+    client = client_id(request)
+    try:
+        admission.admit_job_start(client, event_broker.backlog())
+    except Rejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+    job = start_main_task(refresh, share)
+    admission.track_job(client, job)
+    return job
+
+
+# --- The SSE Generator (one per subscriber) ---
+async def job_sse_generator(job: Job, last_event_id: Optional[int] = None, delta: bool = False):
+    """
+    Streams the events of a job to one client, starting after `last_event_id`.
+    Disconnecting only stops this subscriber; the job itself keeps running.
+    With `delta`, events only carry the fields that changed (see stream_encoding.py).
+    """
+    # Per-connection logs are debug level: at thousands of streams they cost more than
+    # they tell, and the /metrics counters already track streams and disconnects.
+    logger.debug("Client subscribed to job %s (Last-Event-ID: %s).", job.id, last_event_id)
+    ACTIVE_STREAMS.inc()
+    ended = "completed"
+    # Events up to here are replayed from the log; only later ones count for flush latency
+    live_after = job.events.last_id
+    encoder = DeltaEncoder() if delta else None
+    try:
+        yield encode_event(retry=RECONNECT_RETRY_MS) # Tell EventSource how long to wait before reconnecting
+        async for batch in job.subscribe(last_event_id):
+            # Frames are encoded once by the broker and shared by all subscribers (deltas
+            # depend on what this client got before, so they are encoded here);
+            # events that arrived together are sent in a single write.
+            frames = (item.frame for item in batch) if encoder is None else map(encoder.encode, batch)
+            for chunk in join_frames(frames):
+                yield chunk
+                BYTES_SENT.inc(len(chunk))
+            # The generator resumes once the server has written the chunk
+            flushed = time.perf_counter()
+            for item in batch:
+                if item.id > live_after:
+                    FLUSH_LATENCY.observe(flushed - item.created)
+            EVENTS_SENT.inc(len(batch))
+            event_log.debug("Sent %d event(s) of job %s, last id %s.", len(batch), job.id, batch[-1].id)
 
     except asyncio.CancelledError:
-        # This exception is raised if the client disconnects *during* an await call
-        # or if the task is cancelled for other reasons by FastAPI/Uvicorn.
-        logger.warning("Task stream was cancelled (e.g., client disconnected during an await).")
-    except Exception as e:
-        logger.error(f"An unexpected error occurred in the SSE generator: {e}", exc_info=True)
-        # Optionally, send an error event to the client if the connection is still alive
+        # EventSourceResponse watches for the disconnect concurrently and cancels us
+        # right away, even while we wait for the next event of a long step.
+        # Only the subscription is cancelled here, not the job.
+        ended = "client"
+        raise
+    except GeneratorExit:
+        # Closed by the server, e.g. a write got stuck longer than SEND_TIMEOUT_SECONDS
+        ended = "closed"
+        raise
+    finally:
+        ACTIVE_STREAMS.dec()
+        if ended != "completed":
+            DISCONNECTS.labels(ended).inc()
+        logger.debug("SSE generator for job %s finished (%s).", job.id, ended)
+
+
+def tag_with_job(job_id: str, data) -> dict:
+    """Event data of a multiplexed stream carries the id of its job."""
+    if isinstance(data, dict):
+        return {"job_id": job_id, **data}
+    return {"job_id": job_id, "data": data}
+
+
+def parse_stream_cursor(value: Optional[str], count: int) -> list[Optional[int]]:
+    """
+    The event id of a multiplexed stream is the last event id of each job,
+    in the order the jobs were requested ("12,0,7"). Anything else means
+    'replay every job from the start'.
+    """
+    if value:
         try:
-            error_payload = {"error": "An unexpected server error occurred.", "details": str(e)}
-            yield f"event: error\ndata: {json.dumps(error_payload)}\n\n" # Assuming client handles 'error' event
-        except Exception as send_err:
-            logger.error(f"Failed to send error event to client: {send_err}")
+            cursor = [int(part) or None for part in value.split(",")]
+        except ValueError:
+            cursor = []
+        if len(cursor) == count:
+            return cursor
+        logger.warning(f"Ignoring invalid Last-Event-ID for {count} jobs: {value!r}")
+    return [None] * count
+
+
+async def multi_job_sse_generator(jobs: list[Job], last_event_ids: list[Optional[int]], unknown: list[str],
+                                  delta: bool = False):
+    """
+    Streams the events of several jobs over one connection, each tagged with its job_id.
+    A 'jobs' event first lists the jobs (and the ids that are unknown), then the
+    events of all jobs follow in the order they arrive.
+    With `delta`, events carry the fields that changed since the job's previous event
+    of the same type, and always the job_id.
+    """
+    ACTIVE_STREAMS.inc()
+    ended = "completed"
+    cursor = [last_event_id or 0 for last_event_id in last_event_ids]
+    encoder = DeltaEncoder() if delta else None
+    # Small on purpose: when the client is slow, the forwarding tasks wait here and the
+    # per-job subscriber queues apply the slow-consumer policy, as for a single job.
+    batches: asyncio.Queue = asyncio.Queue(maxsize=len(jobs))
+
+    async def forward(index: int, job: Job):
+        async for batch in job.subscribe(last_event_ids[index]):
+            await batches.put((index, batch))
+        await batches.put((index, None))
+
+    forwarders = [asyncio.create_task(forward(index, job)) for index, job in enumerate(jobs)]
+    try:
+        yield encode_event(retry=RECONNECT_RETRY_MS)
+        yield encode_event({"jobs": [job.to_dict() for job in jobs], "unknown": unknown}, "jobs")
+        running = len(jobs)
+        while running:
+            index, batch = await batches.get()
+            if batch is None:
+                running -= 1
+                continue
+            job_id = jobs[index].id
+            frames = []
+            for item in batch:
+                # Unlike single-job frames, these differ per connection (cursor), so they are encoded here
+                cursor[index] = item.id
+                data = item.data if encoder is None else encoder.patch((job_id, item.event), item.data)
+                frames.append(encode_event(tag_with_job(job_id, data), item.event, ",".join(map(str, cursor))))
+            for chunk in join_frames(frames):
+                yield chunk
+                BYTES_SENT.inc(len(chunk))
+            EVENTS_SENT.inc(len(batch))
+            event_log.debug("Sent %d event(s) of job %s on a multi-job stream.", len(batch), job_id)
+
+    except asyncio.CancelledError:
+        ended = "client"
+        raise
+    except GeneratorExit:
+        ended = "closed"
+        raise
     finally:
-        logger.info("Main task SSE generator finished.")
+        for forwarder in forwarders:
+            forwarder.cancel()
+        ACTIVE_STREAMS.dec()
+        if ended != "completed":
+            DISCONNECTS.labels(ended).inc()
+        logger.debug("Multi-job SSE generator for %d job(s) finished (%s).", len(jobs), ended)
+
+
+@routes.post("/jobs", status_code=202)
+async def start_job(request: Request, refresh: bool = False, share: bool = True):
+    """
+    Starts the task pipeline as a background job and returns its id.
+    Use /stream-progress/{job_id} to follow its progress.
+    Pass ?refresh=true to recompute instead of replaying a cached result,
+    and ?share=false for a job of its own that no identical request attaches to.
+    """
+    job = admit_main_task(request, refresh, share)
+    return {"job_id": job.id, "stream_url": f"/stream-progress/{job.id}"}
 
 
-@app.get("/stream-progress")
-async def stream_overall_progress(request: Request):
+@routes.delete("/jobs/{job_id}", status_code=202)
+async def cancel_job(job_id: str):
     """
-    Endpoint that returns the SSE stream for overall task progress.
-    Uses StreamingResponse with the main_task_sse_generator.
+    Cancels a running job, in whichever worker process runs it. Its subscribers get a
+    'cancelled' event and its status becomes "cancelled" once its steps have stopped.
+    Only jobs started with ?share=false can be cancelled: identical requests from other
+    clients may have attached to a shared job, and cancelling it would stop theirs too.
     """
-    # You could add initial checks here if needed, e.g., authentication.
-    return StreamingResponse(main_task_sse_generator(request), media_type="text/event-stream")
+    job = await job_registry.find(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    if job.done:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already finished ({job.status})")
+    if job.key is not None:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is shared with identical requests; "
+                                                    f"start it with ?share=false to be able to cancel it")
+    await job_registry.cancel(job_id)
+    return job.to_dict()
+
+
+@routes.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Returns the current status of a job."""
+    job = await job_registry.find(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict()
+
+
+def heartbeat() -> ServerSentEvent:
+    """Comment frame used as keep-alive; EventSource clients ignore it."""
+    HEARTBEATS_SENT.inc()
+    return ServerSentEvent(comment="ping")
+
+
+def no_heartbeat() -> bytes:
+    # Compressed streams send their heartbeats through the compressor (see compress_stream)
+    return b""
+
+
+def stream_encoding(request: Request, delta: bool, compress: Optional[str]) -> tuple[bool, Optional[str]]:
+    """The opt-in encodings a stream request asked for (see stream_encoding.negotiate)."""
+    return negotiate(request.headers.get("accept"), request.headers.get("accept-encoding"), delta, compress)
+
+
+class AdmittedEventSourceResponse(EventSourceResponse):
+    """An EventSourceResponse that gives its stream's admission ticket back however the stream ends."""
+
+    def __init__(self, *args, ticket: Ticket, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Not a `background` task: sse-starlette skips those when the stream fails,
+            # e.g. on a send timeout, which would leak the slot of every dead client
+            self.ticket.release()
+
+
+def sse_response(content, ticket: Ticket, delta: bool = False, compression: Optional[str] = None) -> EventSourceResponse:
+    """
+    Wraps an SSE generator with heartbeats and dead-client detection:
+    disconnects are noticed concurrently with the running work, and a
+    write that stays stuck for SEND_TIMEOUT_SECONDS closes the stream.
+    The admission `ticket` of the stream is released once the response ends, even if it failed.
+    With a `compression`, the stream is compressed and flushed after every write.
+    """
+    if compression is not None:
+        content = compress_stream(content, compression, STREAM_COMPRESSION_LEVEL, HEARTBEAT_SECONDS)
+    return AdmittedEventSourceResponse(
+        content,
+        headers=response_headers(delta, compression),
+        ping=HEARTBEAT_SECONDS,
+        ping_message_factory=heartbeat if compression is None else no_heartbeat,
+        send_timeout=SEND_TIMEOUT_SECONDS,
+        ticket=ticket,
+    )
+
+
+@routes.get("/metrics")
+async def get_metrics():
+    """Prometheus-style metrics of the streaming server."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    """Event ids are integers; anything else means 'replay from the start'."""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        logger.warning(f"Ignoring invalid Last-Event-ID: {value!r}")
+        return None
+
+
+@routes.get("/stream-progress/{job_id}")
+async def stream_job_progress(request: Request, job_id: str, last_event_id: Optional[str] = Header(default=None),
+                              delta: bool = False, compress: Optional[str] = None):
+    """
+    Endpoint that returns the SSE stream for an existing job.
+    Any number of clients can subscribe to the same job. A reconnecting
+    client that sends `Last-Event-ID` only receives the events it missed.
+    The job may run in another worker process when a backplane is configured.
+    `?delta=true` sends only changed fields and `?compress=gzip` (or deflate)
+    compresses the stream, see stream_encoding.py.
+    """
+    job = await job_registry.find(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    delta, compression = stream_encoding(request, delta, compress)
+    ticket = admit_stream(request)
+    return sse_response(job_sse_generator(job, parse_last_event_id(last_event_id), delta), ticket, delta, compression)
+
+
+@routes.get("/stream-jobs")
+async def stream_jobs_progress(request: Request, job_id: list[str] = Query(),
+                               last_event_id: Optional[str] = Header(default=None),
+                               delta: bool = False, compress: Optional[str] = None):
+    """
+    Endpoint that returns one SSE stream for several jobs (/stream-jobs?job_id=a&job_id=b).
+    Every event is tagged with the `job_id` it belongs to, so a dashboard needs a
+    single connection however many jobs it shows. Unknown ids are listed in the
+    first ('jobs') event instead of failing the whole stream.
+    """
+    job_ids = list(dict.fromkeys(job_id)) # Without duplicates, in the requested order
+    if len(job_ids) > MAX_JOBS_PER_STREAM:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_JOBS_PER_STREAM} jobs per stream")
+    found = await asyncio.gather(*(job_registry.find(requested) for requested in job_ids))
+    jobs = [job for job in found if job is not None]
+    if not jobs:
+        raise HTTPException(status_code=404, detail=f"Unknown jobs: {', '.join(job_ids)}")
+    unknown = [requested for requested, job in zip(job_ids, found) if job is None]
+    cursor = parse_stream_cursor(last_event_id, len(jobs))
+    delta, compression = stream_encoding(request, delta, compress)
+    ticket = admit_stream(request)
+    return sse_response(multi_job_sse_generator(jobs, cursor, unknown, delta), ticket, delta, compression)
+
+
+@routes.get("/stream-progress")
+async def stream_overall_progress(request: Request, refresh: bool = False, share: bool = True,
+                                  delta: bool = False, compress: Optional[str] = None):
+    """
+    Starts a new job and streams its progress in a single request.
+    Kept for clients that do not use POST /jobs yet.
+    """
+    delta, compression = stream_encoding(request, delta, compress)
+    ticket = admit_stream(request)
+    try:
+        job = admit_main_task(request, refresh, share)
+    except HTTPException:
+        ticket.release()
+        raise
+    return sse_response(job_sse_generator(job, delta=delta), ticket, delta, compression)
+
+
+# --- App factory ---
+# Importing this module only defines things; create_app() configures logging,
+# imports and creates the optional backends and builds the routes, once.
+# `uvicorn main_progress:app` gets the app through __getattr__ below, and
+# `uvicorn --factory main_progress:create_app` calls the factory itself.
+@functools.cache
+def create_app() -> FastAPI:
+    global backplane, job_log_store, job_registry
+    logging.basicConfig(level=logging.INFO)
+    if BACKPLANE_SOCKET:
+        from backplane import LocalBackplane
+        backplane = LocalBackplane(BACKPLANE_SOCKET, EVENT_LOG_SIZE)
+    if JOB_LOG_DIR:
+        from durable_log import JobLogStore
+        job_log_store = JobLogStore(
+            JOB_LOG_DIR, JOB_LOG_FSYNC_INTERVAL, EVENT_LOG_SIZE, JOB_LOG_RETENTION_SECONDS, JOB_LOG_MAX_BYTES,
+        )
+    job_registry = JobRegistry(
+        event_broker, event_log_size=EVENT_LOG_SIZE,
+        backplane=backplane, store=job_log_store, abandon_after=ABANDONED_JOB_GRACE_SECONDS,
+    )
+    app = FastAPI(lifespan=lifespan)
+    routes.include_in(app)
+    return app
+
+
+def __getattr__(name: str):
+    # Module attributes that are not defined yet (PEP 562): `app` is created on first access
+    if name == "app":
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
+    import uvicorn
     # Make sure the file name here matches your actual file name if it's not 'main_progress.py'
     # For example, if your file is my_sse_app.py, use "my_sse_app:app"
     uvicorn.run("main_progress:app", host="0.0.0.0", port=8000, reload=True, log_level="info")
@@ -0,0 +1,216 @@
+import bisect
+import logging
+import math
+from typing import Iterator, Optional
+
+# Small Prometheus-style metrics, rendered in the text exposition format by /metrics.
+# Metrics are only updated from the event loop thread, so they need no locks
+# and updating one is about as cheap as incrementing an attribute.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: dict[tuple, "_Metric"] = {}
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values) -> "_Metric":
+        """The child metric for one combination of label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.documentation)
+
+    def _own_samples(self) -> Iterator[tuple[str, dict, float]]:
+        raise NotImplementedError
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        if not self.labelnames:
+            yield from self._own_samples()
+            return
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, values))
+            for suffix, extra, value in child._own_samples():
+                yield suffix, {**labels, **extra}, value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0.0
+        super().__init__(*args, **kwargs)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _own_samples(self):
+        yield "_total", {}, self.value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        self.value = 0.0
+        super().__init__(*args, **kwargs)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def _own_samples(self):
+        yield "", {}, self.value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 registry: Optional["Registry"] = None, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _own_samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield "_bucket", {"le": _format_value(bound)}, cumulative
+        yield "_sum", {}, self.sum
+        yield "_count", {}, self.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- The metrics of the streaming server ---
+ACTIVE_STREAMS = Gauge("sse_active_streams", "SSE streams currently open.", registry=REGISTRY)
+EVENTS_SENT = Counter("sse_events_sent", "Events written to SSE streams.", registry=REGISTRY)
+BYTES_SENT = Counter("sse_bytes_sent", "Bytes of event frames written to SSE streams.", registry=REGISTRY)
+COMPRESSED_BYTES_SENT = Counter(
+    "sse_compressed_bytes_sent", "Bytes written to compressed SSE streams, after compression.", registry=REGISTRY,
+)
+HEARTBEATS_SENT = Counter("sse_heartbeats_sent", "Keep-alive comment frames sent.", registry=REGISTRY)
+DISCONNECTS = Counter(
+    "sse_disconnects", "SSE streams that ended before the job finished, by reason.",
+    ("reason",), registry=REGISTRY,
+)
+EVENTS_DROPPED = Counter(
+    "sse_events_dropped", "Events dropped from slow subscribers' queues, by policy.",
+    ("policy",), registry=REGISTRY,
+)
+QUEUE_DEPTH = Histogram(
+    "sse_subscriber_queue_depth", "Events waiting in a subscriber's queue when it is read.",
+    registry=REGISTRY, buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+FLUSH_LATENCY = Histogram(
+    "sse_event_flush_latency_seconds", "Time from publishing a live event to writing it to a stream.",
+    registry=REGISTRY,
+)
+STEP_DURATION = Histogram(
+    "pipeline_step_duration_seconds", "Duration of pipeline steps, by step.",
+    ("step",), registry=REGISTRY, buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+JOBS_STARTED = Counter("jobs_started", "Jobs started.", registry=REGISTRY)
+JOBS_FINISHED = Counter("jobs_finished", "Jobs finished, by final status.", ("status",), registry=REGISTRY)
+JOBS_DEDUPLICATED = Counter(
+    "jobs_deduplicated", "Job requests that attached to an identical running job.", registry=REGISTRY,
+)
+RESULT_CACHE_LOOKUPS = Counter(
+    "result_cache_lookups", "Result cache lookups, by result (hit, miss or bypass).",
+    ("result",), registry=REGISTRY,
+)
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections", "Requests turned away by admission control, by reason.",
+    ("reason",), registry=REGISTRY,
+)
+JOB_LOG_BYTES_WRITTEN = Counter("job_log_bytes_written", "Bytes appended to on-disk job logs.", registry=REGISTRY)
+JOB_LOG_FSYNC_SECONDS = Histogram(
+    "job_log_fsync_seconds", "Time to write out and fsync the job logs with new events.", registry=REGISTRY,
+)
+
+
+class SampledLogger:
+    """
+    Logs only one out of every `every` messages, at debug level.
+    For the hot path, where a formatted log line per event costs more than the event.
+    Arguments are formatted lazily, so skipped messages cost almost nothing.
+    """
+
+    def __init__(self, logger: logging.Logger, every: int = 100):
+        self.logger = logger
+        self.every = every
+        self._count = 0
+
+    def debug(self, msg: str, *args):
+        self._count += 1
+        if self._count % self.every == 1 or self.every == 1:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(msg + " (1 of every %d logged)", *args, self.every)
@@ -0,0 +1,52 @@
+import time
+from typing import Callable, Optional
+
+from cancellation import CancellationToken
+
+
+class ProgressReporter:
+    """
+    Handle passed to a step so it can report how far along it is:
+
+        for i, item in enumerate(items):
+            process(item)
+            reporter.update(i + 1, len(items))
+
+    Updates are throttled: one is only passed on when at least `min_interval`
+    seconds have passed and the percentage moved by at least `min_delta`
+    since the last one. Calling update() in a tight loop is therefore cheap
+    and does not turn into one SSE event per call. Reaching `total` is always
+    passed on, so the final state is never lost.
+    With a `cancel_token`, update() raises Cancelled once the job is cancelled,
+    so a step that reports progress also stops without checking the token itself.
+    """
+
+    def __init__(self, sink: Callable[[int, int], None], min_interval: float = 0.25, min_delta: float = 1.0,
+                 cancel_token: Optional[CancellationToken] = None):
+        self._sink = sink
+        self._cancel_token = cancel_token
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self._last_percent = -float("inf")
+        self._last_time = -float("inf")
+        self.emitted = 0
+        self.suppressed = 0
+
+    def update(self, done: int, total: int, force: bool = False):
+        """Report that `done` out of `total` units of work are finished."""
+        if self._cancel_token is not None:
+            self._cancel_token.raise_if_cancelled()
+        if total <= 0:
+            return
+        percent = done * 100 / total
+        if not force and done < total:
+            # Cheapest check first, the clock is only read when the percentage moved enough
+            if percent - self._last_percent < self.min_delta or time.monotonic() - self._last_time < self.min_interval:
+                self.suppressed += 1
+                return
+        elif done >= total and self._last_percent >= 100:
+            return # Completion was already reported
+        self._last_percent = percent
+        self._last_time = time.monotonic()
+        self.emitted += 1
+        self._sink(done, total)
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(name: str, params: Optional[dict] = None) -> str:
+    """A stable key for a task run: the task name plus its parameters in canonical JSON."""
+    canonical = json.dumps({"task": name, "params": params or {}}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Results of finished task runs, by cache key.
+    Entries expire `ttl_seconds` after they were stored, and once there are
+    more than `max_entries` the least recently used one is evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0, max_entries: int = 128):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Any):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            logger.debug("Evicted cached result %s", evicted)
+
+    def invalidate(self, key: Optional[str] = None):
+        """Forget one cached result, or all of them."""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
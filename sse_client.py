@@ -0,0 +1,298 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# The read timeout must be longer than the server's heartbeat interval (15 s),
+# so that only a connection that really went quiet is dropped.
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, read=60.0)
+# Statuses worth retrying; any other error status is raised right away
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+@dataclass
+class SSEEvent:
+    event: str = "message"
+    data: str = ""
+    id: Optional[str] = None
+
+    def json(self):
+        return json.loads(self.data)
+
+
+class SSEParser:
+    """
+    Turns the lines of an event stream into events, following the SSE spec:
+    `data` lines are joined, comments (heartbeats) are skipped, and the last
+    event id and `retry` value are remembered across events.
+    """
+
+    def __init__(self, last_event_id: Optional[str] = None):
+        self.last_event_id = last_event_id
+        self.retry_ms: Optional[int] = None
+        self._event = ""
+        self._data: list[str] = []
+
+    def feed(self, line: str) -> Optional[SSEEvent]:
+        """Feed one line (without its line break); returns an event when one is complete."""
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self.last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self.retry_ms = int(value)
+        return None
+
+    def discard_partial(self):
+        """Drop a half-received event, e.g. when the connection broke in the middle of it."""
+        self._event, self._data = "", []
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        event, data = self._event, self._data
+        self._event, self._data = "", []
+        if not data:
+            return None # e.g. a frame with only retry:
+        return SSEEvent(event or "message", "\n".join(data), self.last_event_id)
+
+
+def apply_merge_patch(target: Any, patch: Any) -> Any:
+    """Apply a JSON merge patch (RFC 7386): changed fields replace, null removes."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+class Backoff:
+    """
+    Jittered exponential backoff ("full jitter"): attempt n waits a random time
+    between 0 and min(max_delay, base * 2**n). The randomness spreads out clients
+    that lost their connection at the same time, e.g. during a deploy, so they
+    do not all reconnect at once.
+    """
+
+    def __init__(self, base: float = 1.0, max_delay: float = 30.0):
+        self.base = base
+        self.max_delay = max_delay
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class _RetryableStatus(Exception):
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"HTTP {response.status_code} from {response.url}")
+        self.retry_after = _retry_after_seconds(response)
+
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+class _SSEClientBase:
+    def __init__(self, url: str, *, params=None, headers: Optional[dict] = None,
+                 last_event_id: Optional[str] = None, backoff: Optional[Backoff] = None,
+                 max_attempts: Optional[int] = None, delta: bool = False, compress: Optional[str] = None):
+        self.url = url
+        self.params = params
+        # Opt-in compact encodings (see the server's stream_encoding.py); httpx decompresses on its own
+        accept = "text/event-stream"
+        if delta:
+            accept += "; delta=merge-patch"
+        if compress:
+            accept += f"; compress={compress}"
+        self.headers = {"Accept": accept, "Cache-Control": "no-cache", **(headers or {})}
+        self.parser = SSEParser(last_event_id)
+        # Whether the current response is delta encoded, and the last full data per event type (and job)
+        self._delta = False
+        self._delta_state: dict[tuple, Any] = {}
+        self.backoff = backoff or Backoff()
+        # Consecutive failed attempts before giving up (None: keep trying)
+        self.max_attempts = max_attempts
+        self.connected = False
+        self.closed = False
+
+    @property
+    def last_event_id(self) -> Optional[str]:
+        return self.parser.last_event_id
+
+    def _request_headers(self) -> dict:
+        # Resume after the last event we received, like EventSource does
+        if self.parser.last_event_id:
+            return {**self.headers, "Last-Event-ID": self.parser.last_event_id}
+        return self.headers
+
+    def _check(self, response: httpx.Response) -> bool:
+        """Returns False when the server asks us to stop (204), raises for error statuses."""
+        if response.status_code == 204:
+            return False
+        if response.status_code in RETRY_STATUSES:
+            raise _RetryableStatus(response)
+        response.raise_for_status()
+        # The server starts over with whole events on every connection
+        self._delta = response.headers.get("X-Delta-Encoding") == "merge-patch"
+        self._delta_state.clear()
+        return True
+
+    def _decode(self, event: SSEEvent) -> SSEEvent:
+        """Turns a delta-encoded event back into the whole event."""
+        if not self._delta:
+            return event
+        try:
+            patch = json.loads(event.data)
+        except ValueError:
+            return event
+        key = (event.event, patch.get("job_id") if isinstance(patch, dict) else None)
+        data = self._delta_state[key] = apply_merge_patch(self._delta_state.get(key), patch)
+        return SSEEvent(event.event, json.dumps(data), event.id)
+
+    def _retry_delay(self, error: Exception) -> float:
+        """How long to wait before the next attempt; raises `error` once we give up."""
+        self.connected = False
+        if self.max_attempts is not None and self.backoff.attempt + 1 >= self.max_attempts:
+            raise error
+        # The server's retry: value is the base delay, as EventSource uses it
+        if self.parser.retry_ms is not None:
+            self.backoff.base = self.parser.retry_ms / 1000
+        delay = self.backoff.next_delay()
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        logger.info(f"SSE stream {self.url} interrupted ({error}); reconnecting in {delay:.2f}s.")
+        return delay
+
+
+class SSEClient(_SSEClientBase):
+    """
+    Reads an event stream and reconnects when it is interrupted, resuming with
+    Last-Event-ID. Iterate over it to get events; stop by breaking out of the loop
+    or calling close() (also from another thread).
+
+        with SSEClient(f"{url}/stream-progress/{job_id}") as stream:
+            for event in stream:
+                ...
+
+    Pass a shared `httpx.Client` to reuse its connection pool across streams;
+    otherwise the stream makes its own and keeps it across reconnects.
+    With `delta=True` and/or `compress="gzip"`, the server sends less (only the
+    changed fields, compressed); the events yielded here are whole either way.
+    """
+
+    def __init__(self, url: str, *, client: Optional[httpx.Client] = None, **kwargs):
+        super().__init__(url, **kwargs)
+        self._owns_client = client is None
+        self._client = client or httpx.Client(timeout=DEFAULT_TIMEOUT)
+        self._response: Optional[httpx.Response] = None
+
+    def __iter__(self) -> Iterator[SSEEvent]:
+        while not self.closed:
+            try:
+                with self._client.stream("GET", self.url, params=self.params, headers=self._request_headers(),
+                                         timeout=DEFAULT_TIMEOUT) as response:
+                    self._response = response
+                    self.parser.discard_partial()
+                    if not self._check(response):
+                        return
+                    self.connected = True
+                    self.backoff.reset()
+                    for line in response.iter_lines():
+                        event = self.parser.feed(line)
+                        if event is not None:
+                            yield self._decode(event)
+                error = httpx.RemoteProtocolError("stream ended")
+            except (httpx.TransportError, _RetryableStatus) as e:
+                error = e
+            except Exception:
+                if self.closed:
+                    return # close() from another thread interrupted the read
+                raise
+            finally:
+                self._response = None
+            if self.closed:
+                return
+            time.sleep(self._retry_delay(error))
+
+    def close(self):
+        self.closed = True
+        response = self._response
+        if response is not None:
+            response.close()
+        if self._owns_client:
+            self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncSSEClient(_SSEClientBase):
+    """The same as SSEClient, for asyncio code (`async for event in stream`)."""
+
+    def __init__(self, url: str, *, client: Optional[httpx.AsyncClient] = None, **kwargs):
+        super().__init__(url, **kwargs)
+        self._owns_client = client is None
+        self._client = client or httpx.AsyncClient(timeout=DEFAULT_TIMEOUT)
+
+    async def __aiter__(self) -> AsyncIterator[SSEEvent]:
+        while not self.closed:
+            try:
+                async with self._client.stream("GET", self.url, params=self.params,
+                                               headers=self._request_headers(), timeout=DEFAULT_TIMEOUT) as response:
+                    self.parser.discard_partial()
+                    if not self._check(response):
+                        return
+                    self.connected = True
+                    self.backoff.reset()
+                    async for line in response.aiter_lines():
+                        event = self.parser.feed(line)
+                        if event is not None:
+                            yield self._decode(event)
+                error = httpx.RemoteProtocolError("stream ended")
+            except (httpx.TransportError, _RetryableStatus) as e:
+                error = e
+            if self.closed:
+                return
+            await asyncio.sleep(self._retry_delay(error))
+
+    async def aclose(self):
+        self.closed = True
+        if self._owns_client:
+            await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
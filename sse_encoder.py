@@ -0,0 +1,113 @@
+import json
+import logging
+from typing import Any, Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Use orjson when it is installed (`pip install orjson`), it returns bytes directly
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Built once: json.dumps() with non-default arguments creates a new encoder per call.
+# The output is pure ASCII, so encoding it to bytes is cheap.
+_stdlib_encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def _stdlib_json_dumps(data: Any) -> bytes:
+    return _stdlib_encoder.encode(data).encode("ascii")
+
+
+def _orjson_dumps(data: Any) -> bytes:
+    return orjson.dumps(data)
+
+
+# The serializer used for event data, see set_json_dumps()
+json_dumps: Callable[[Any], bytes] = _orjson_dumps if orjson is not None else _stdlib_json_dumps
+
+
+def set_json_dumps(dumps: Optional[Callable[[Any], bytes]]):
+    """
+    Plug in a different JSON serializer. It must return UTF-8 bytes.
+    Pass None to go back to the default (orjson if installed, else the stdlib).
+    """
+    global json_dumps
+    if dumps is None:
+        dumps = _orjson_dumps if orjson is not None else _stdlib_json_dumps
+    json_dumps = dumps
+    logger.info(f"SSE encoder JSON backend: {getattr(dumps, '__name__', dumps)}")
+
+
+def _field(name: bytes, value: Any) -> bytes:
+    if type(value) is int:
+        return b"%s: %d\n" % (name, value)
+    value = str(value)
+    if "\n" in value or "\r" in value:
+        raise ValueError(f"SSE {name.decode()} field cannot contain line breaks: {value!r}")
+    return name + b": " + value.encode("utf-8") + b"\n"
+
+
+# There are only a handful of event names, so each "event:" line is encoded once
+_event_fields: dict[str, bytes] = {}
+
+
+def encode_event(
+    data: Any = None,
+    event: Optional[str] = None,
+    event_id: Optional[int | str] = None,
+    retry: Optional[int] = None,
+) -> bytes:
+    """
+    Encode one SSE frame as bytes.
+    `data` can be bytes or str (sent as is) or anything else (serialized to JSON).
+    Data with several lines is split into several `data:` lines, as the spec requires.
+    """
+    if event_id is None:
+        head = b""
+    elif type(event_id) is int:
+        head = b"id: %d\n" % event_id
+    else:
+        head = _field(b"id", event_id)
+    if event is not None:
+        event_field = _event_fields.get(event)
+        if event_field is None:
+            event_field = _event_fields.setdefault(event, _field(b"event", event))
+        head += event_field
+    if retry is not None:
+        head += b"retry: %d\n" % retry
+    if data is None:
+        return head + b"\n"
+    if isinstance(data, (str, bytes)):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        lines = data.splitlines() or [b""]
+        return head + b"".join(b"data: " + line + b"\n" for line in lines) + b"\n"
+    # Serialized JSON never contains raw line breaks, so it is always one line
+    return b"%sdata: %s\n\n" % (head, json_dumps(data))
+
+
+def encode_comment(text: str = "") -> bytes:
+    """Encode an SSE comment line, which clients ignore (useful as a keep-alive)."""
+    return b"".join(b": " + line.encode("utf-8") + b"\n" for line in (text.splitlines() or [""])) + b"\n"
+
+
+def join_frames(frames: Iterable[bytes], max_bytes: int = 64 * 1024) -> list[bytes]:
+    """
+    Coalesce encoded frames into as few writes as possible,
+    each at most `max_bytes` long (a single larger frame is kept whole).
+    """
+    writes = []
+    batch = []
+    size = 0
+    for frame in frames:
+        if batch and size + len(frame) > max_bytes:
+            writes.append(b"".join(batch))
+            batch = []
+            size = 0
+        batch.append(frame)
+        size += len(frame)
+    if batch:
+        writes.append(b"".join(batch))
+    return writes
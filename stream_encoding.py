@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import zlib
+from typing import Any, AsyncIterator, Hashable, Optional
+
+from metrics import COMPRESSED_BYTES_SENT, HEARTBEATS_SENT
+from sse_encoder import encode_comment, encode_event
+
+logger = logging.getLogger(__name__)
+
+# --- Opt-in compact encodings for event streams ---
+# Delta: the data of an event is a JSON merge patch (RFC 7386) against the previous
+# event of the same type on the same connection: only the fields that changed, and
+# removed fields as null. The first event of each type is sent whole.
+# Compression: the stream is gzip or deflate encoded, and flushed after every write,
+# so the client can decode each event as soon as it arrives.
+DELTA_ENCODING = "merge-patch"  # Value of the X-Delta-Encoding response header in delta mode
+COMPRESSIONS = {"gzip": 16 + 12, "deflate": 12}  # zlib wbits: a 4 KiB window is plenty for events
+COMPRESSION_MEM_LEVEL = 5  # With the small window, about 32 KiB of zlib state per stream
+
+
+def merge_patch(previous: Any, current: Any) -> Any:
+    """The JSON merge patch that turns `previous` into `current`."""
+    if not isinstance(previous, dict) or not isinstance(current, dict):
+        return current
+    patch = {}
+    for key, value in current.items():
+        old = previous.get(key)
+        if key in previous and type(old) is type(value) and old == value:
+            continue
+        patch[key] = merge_patch(old, value) if isinstance(old, dict) and isinstance(value, dict) else value
+    for key in previous:
+        if key not in current:
+            patch[key] = None
+    return patch
+
+
+class DeltaEncoder:
+    """
+    Per-connection state of a delta-encoded stream: the last data sent for each key
+    (the event type, or the job and the event type on a multiplexed stream).
+    """
+
+    def __init__(self):
+        self._previous: dict[Hashable, Any] = {}
+
+    def patch(self, key: Hashable, data: Any) -> Any:
+        previous = self._previous.get(key)
+        self._previous[key] = data
+        return data if previous is None else merge_patch(previous, data)
+
+    def encode(self, item) -> bytes:
+        """The frame of a BrokerEvent; the first of its type is the frame the broker already encoded."""
+        if item.event not in self._previous:
+            self._previous[item.event] = item.data
+            return item.frame
+        return encode_event(self.patch(item.event, item.data), item.event, item.id)
+
+
+def _accept_params(accept: Optional[str]) -> dict[str, str]:
+    # Parameters of the text/event-stream entry, e.g. "text/event-stream; delta=merge-patch; compress=gzip"
+    for entry in (accept or "").split(","):
+        media_type, *params = entry.split(";")
+        if media_type.strip().lower() == "text/event-stream":
+            return {
+                name.strip().lower(): value.strip().strip('"').lower()
+                for name, _, value in (param.partition("=") for param in params)
+            }
+    return {}
+
+
+def negotiate(accept: Optional[str], accept_encoding: Optional[str],
+              delta: bool = False, compress: Optional[str] = None) -> tuple[bool, Optional[str]]:
+    """
+    Which encodings a stream uses: delta mode and a compression (or None).
+    Both are opt-in, with the `delta` and `compress` query parameters or the
+    same parameters on text/event-stream in the Accept header. A compression
+    is only used if Accept-Encoding says the client can decode it.
+    """
+    params = _accept_params(accept)
+    delta = delta or params.get("delta") in (DELTA_ENCODING, "1", "true")
+    compress = (compress or params.get("compress") or "").lower() or None
+    if compress is not None:
+        accepted = {coding.split(";")[0].strip().lower() for coding in (accept_encoding or "").split(",")}
+        if compress not in COMPRESSIONS or compress not in accepted:
+            logger.debug(f"Not compressing the stream with {compress!r} (Accept-Encoding: {accept_encoding!r}).")
+            compress = None
+    return delta, compress
+
+
+def response_headers(delta: bool, compression: Optional[str]) -> dict:
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if delta:
+        headers["X-Delta-Encoding"] = DELTA_ENCODING
+    if compression is not None:
+        headers["Content-Encoding"] = compression
+    return headers
+
+
+async def compress_stream(content: AsyncIterator[bytes], compression: str, level: int,
+                          heartbeat_seconds: float) -> AsyncIterator[bytes]:
+    """
+    Compresses the chunks of an SSE generator, flushing after each one.
+    Heartbeats have to go through the same compressor, so they are sent from
+    here: when no chunk comes for `heartbeat_seconds`, a comment frame is.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, COMPRESSIONS[compression], COMPRESSION_MEM_LEVEL)
+
+    def compressed(chunk: bytes) -> bytes:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        COMPRESSED_BYTES_SENT.inc(len(data))
+        return data
+
+    # The generator runs in a task of its own, so a heartbeat can be sent while it waits
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(content.__anext__())
+            done, _ = await asyncio.wait((pending,), timeout=heartbeat_seconds)
+            if not done:
+                HEARTBEATS_SENT.inc()
+                yield compressed(encode_comment("ping"))
+                continue
+            next_chunk, pending = pending, None
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            yield compressed(chunk)
+        yield compressor.flush()
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        await content.aclose()
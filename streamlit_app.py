@@ -1,9 +1,12 @@
 # --- START OF FILE streamlit_app.py ---
 import streamlit as st
-import requests
-import sseclient
+import httpx
 import json
-import time
+import threading
+import uuid
+from collections import deque
+
+from sse_client import SSEClient
 
 # --- Configuration ---
 FASTAPI_BACKEND_URL = "http://127.0.0.1:8000"  # Adjust if your FastAPI runs elsewhere
@@ -17,119 +20,422 @@ This app connects to a FastAPI backend (`{FASTAPI_BACKEND_URL}`)
 that performs a sequence of tasks and streams progress updates using Server-Sent Events (SSE).
 """)
 
-# --- Button to start the process ---
-if st.button("Start Task and Monitor Progress", key="start_task"):
-
-    # --- UI Placeholders ---
-    # We create placeholders first, then update them within the SSE loop.
-    st.info("Attempting to connect to the backend stream...")
-    progress_bar_placeholder = st.empty()
-    status_text_placeholder = st.empty()
-    result_placeholder = st.empty()
-
-    # Initialize UI elements
-    progress_bar_placeholder.progress(0)
-    status_text_placeholder.info("Status: Waiting for connection...")
-    result_placeholder.empty() # Clear previous results if any
-
-    try:
-        # --- Connect to the SSE stream ---
-        # Using requests with stream=True and wrapping with sseclient
-        response = requests.get(f"{FASTAPI_BACKEND_URL}/stream-progress", stream=True, headers={'Accept': 'text/event-stream'})
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        client = sseclient.SSEClient(response)
-
-        st.success("✅ Connected to the backend stream. Waiting for updates...")
-
-        # --- Process events from the stream ---
-        for event in client.events():
-            # Heartbeat/keep-alive messages might be empty or just comments
-            if not event.data:
-                # You could add a st.spinner or log here if you want to see keep-alives
-                # print("Received keep-alive or empty message")
-                continue
-
-            # Attempt to parse the data as JSON
-            try:
-                data = json.loads(event.data)
-            except json.JSONDecodeError:
-                st.warning(f"⚠️ Received non-JSON data: {event.data}")
-                continue # Skip this event if it's not valid JSON
-
-            # --- Handle 'progress' events ---
-            if event.event == 'progress':
+# --- Reading the stream of a job in the background ---
+UI_REFRESH_SECONDS = 0.25  # The page is redrawn at most this often, however fast events arrive
+EVENT_LOG_MAX_LINES = 50  # Only the most recent events are listed
+STREAM_MAX_ATTEMPTS = 8  # Failed reconnects in a row before a reader gives up (with backoff in between)
+# Ask for only the changed fields of each event, gzip compressed; SSEClient hands us whole events anyway
+STREAM_DELTA = True
+STREAM_COMPRESSION = "gzip"  # Or "deflate", or None
+CLIENT_ID_HEADER = "X-Client-Id"  # The same as the backend's CLIENT_ID_HEADER
+
+
+@st.cache_resource
+def http_client():
+    """
+    One connection pool for the whole app, created on first use and reused by
+    every session and rerun (httpx.Client is thread-safe). Each open stream
+    holds a connection, so the number of connections is not capped here.
+    """
+    return httpx.Client(limits=httpx.Limits(max_connections=None, max_keepalive_connections=20))
+
+
+def session_headers():
+    """
+    Names this browser session in every request, so the backend's per-client limits
+    apply to each session instead of to all of them together (they share our address).
+    """
+    if "client_id" not in st.session_state:
+        st.session_state["client_id"] = uuid.uuid4().hex
+    return {CLIENT_ID_HEADER: st.session_state["client_id"]}
+
+
+class JobStreamReader:
+    """
+    Reads the SSE stream of a job in a background thread, so the script never blocks on it.
+    The thread only records what it receives: the latest progress (older updates
+    are simply overwritten), a capped log of messages and the final result.
+    The page redraws from snapshot() on a timer, so a fast stream costs one
+    redraw per UI_REFRESH_SECONDS instead of one per event.
+    """
+
+    def __init__(self, job_id, client, last_event_id=None, progress=(0, "Waiting for connection..."),
+                 log_size=EVENT_LOG_MAX_LINES, headers=None):
+        self.job_id = job_id
+        self._client = client
+        # Taken from the session by the script thread: the reader thread cannot read st.session_state
+        self._headers = headers
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._stream = None
+        # Shared with the script thread, always accessed under the lock
+        self._state = {
+            "finished": False,   # The job completed, failed or was cancelled
+            "stopped": False,    # The reader is done (finished, stopped or lost the connection)
+            "last_event_id": last_event_id,
+            "progress": progress,
+            "events_received": 0,
+            "log": deque(maxlen=log_size),
+            "result": None,
+            "error": None,
+            "cancelled": None,   # Why the job was cancelled
+        }
+        self._thread = threading.Thread(target=self._run, name=f"sse-{job_id[:8]}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop reading; closing the stream wakes up the thread if it is waiting for an event."""
+        self._stopped.set()
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self._state, "log": list(self._state["log"]), "connected": self._connected()}
+
+    def _connected(self):
+        # False while the stream is reconnecting
+        return self._stream is not None and self._stream.connected
+
+    def _update(self, **changes):
+        with self._lock:
+            self._state.update(changes)
+
+    def _stream_url(self):
+        return f"{FASTAPI_BACKEND_URL}/stream-progress/{self.job_id}", None
+
+    def _run(self):
+        url, params = self._stream_url()
+        # Reconnects with backoff on its own, and only asks for the events we have not seen yet
+        self._stream = SSEClient(
+            url, client=self._client, params=params, headers=self._headers,
+            last_event_id=self._state["last_event_id"], max_attempts=STREAM_MAX_ATTEMPTS,
+            delta=STREAM_DELTA, compress=STREAM_COMPRESSION,
+        )
+        try:
+            for event in self._stream:
+                if self._stopped.is_set():
+                    break
+                if self._handle(event):
+                    break
+        except httpx.TransportError as e:
+            self._fail(
+                f"❌ **Connection Error:** Lost the connection to the backend at `{FASTAPI_BACKEND_URL}`.\n"
+                f"Please ensure the FastAPI server (`main_progress.py`) is running.\n"
+                f"Details: {e}"
+            )
+        except httpx.HTTPError as e:
+            self._fail(f"❌ **Request Error:** An error occurred during the request to the backend.\nDetails: {e}")
+        except Exception as e:
+            # Any other unexpected errors during stream processing
+            self._fail(f"💥 **An unexpected error occurred:**\n{e}")
+        finally:
+            self._stream.close()
+            self._update(stopped=True)
+
+    def _fail(self, message):
+        # Errors caused by stop() closing the response are expected
+        if not self._stopped.is_set():
+            self._update(error=message)
+
+    def _handle(self, event):
+        """Records one event; returns True once the stream is over."""
+        # Heartbeat/keep-alive messages might be empty or just comments
+        if not event.data:
+            return False
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError:
+            data = None
+        with self._lock:
+            state = self._state
+            state["events_received"] += 1
+            # Remember where we are in the stream, so a resume only replays what we missed
+            if event.id:
+                state["last_event_id"] = event.id
+            if data is None:
+                state["log"].append(f"⚠️ Received non-JSON data: {event.data}")
+            elif event.event == 'progress':
                 percent = data.get("percent", 0)
                 message = data.get("message", "Processing...")
+                state["progress"] = (percent, f"{message} ({percent}%)")
+                state["log"].append(f"{percent}% - {message}")
+            elif event.event == 'complete':
+                state["progress"] = (100, "Task Completed!")
+                state["result"] = data
+                state["finished"] = True
+                return True
+            elif event.event == 'error':
+                error_msg = data.get("error", "Unknown error occurred.")
+                details = data.get("details", "")
+                state["error"] = f"**Error:** {error_msg}\nDetails: {details}"
+                state["finished"] = True
+                return True
+            elif event.event == 'cancelled':
+                state["cancelled"] = data.get("reason", "The job was cancelled.")
+                state["finished"] = True
+                return True
+            else:
+                # This might catch default 'message' events if the server sends them
+                state["log"].append(f"Received unhandled event type '{event.event}': {event.data}")
+        return False
 
-                # Update Streamlit elements
-                progress_bar_placeholder.progress(percent / 100.0) # st.progress expects 0.0 to 1.0
-                status_text_placeholder.info(f"Status: {message} ({percent}%)")
-                st.write(f"Received progress: {percent}% - {message}") # Optional: log updates
 
-            # --- Handle 'complete' event ---
-            elif event.event == 'complete':
-                result = data.get("result", "Task finished successfully!")
-                summary = data.get("summary", {}) # Get the summary if available
+def watch_job(job_id, resume=False):
+    """
+    Starts a background reader for the stream of a job, replacing any previous one.
+    The job runs on the backend independently of this connection, so with
+    `resume` the new reader continues where the previous one stopped.
+    """
+    previous = st.session_state.get("reader")
+    if previous is not None:
+        previous.stop()
+    if resume and previous is not None and previous.job_id == job_id:
+        state = previous.snapshot()
+        reader = JobStreamReader(job_id, http_client(), state["last_event_id"], state["progress"],
+                                 headers=session_headers())
+    else:
+        reader = JobStreamReader(job_id, http_client(), headers=session_headers())
+    st.session_state["reader"] = reader.start()
+    st.session_state["celebrated"] = False
 
-                # Update Streamlit elements to final state
-                progress_bar_placeholder.progress(1.0) # Ensure bar is full
-                status_text_placeholder.success("Status: Task Completed!")
-                result_placeholder.success(f"**Result:** {result}")
 
-                if summary:
-                    st.subheader("Task Summary:")
-                    st.json(summary) # Display the summary nicely
+def render_job_state(state):
+    """Draws a snapshot of a reader's state."""
+    if not state["stopped"] and not state["connected"]:
+        st.info("Attempting to connect to the backend stream...")
+    percent, message = state["progress"]
+    if state["error"] is not None:
+        st.error("Status: An error occurred!")
+        st.error(state["error"])
+    elif state["cancelled"] is not None:
+        st.progress(percent / 100.0)
+        st.warning(f"Status: Cancelled. {state['cancelled']}")
+    elif state["result"] is not None:
+        st.progress(1.0) # Ensure bar is full
+        st.success("Status: Task Completed!")
+        st.success(f"**Result:** {state['result'].get('result', 'Task finished successfully!')}")
+        summary = state["result"].get("summary", {}) # Get the summary if available
+        if summary:
+            st.subheader("Task Summary:")
+            st.json(summary) # Display the summary nicely
+    else:
+        st.progress(percent / 100.0) # st.progress expects 0.0 to 1.0
+        st.info(f"Status: {message}")
+    with st.expander(f"Event log ({state['events_received']} events received)"):
+        # One element holding the last EVENT_LOG_MAX_LINES lines, so the page does not grow
+        st.text("\n".join(state["log"]) or "No events yet.")
 
-                st.balloons() # Fun celebration!
-                st.write("Stream finished.")
-                break # Exit the loop as the task is done
 
-            # --- Handle potential custom 'error' events (if you added them) ---
-            elif event.event == 'error':
-                 error_msg = data.get("error", "Unknown error occurred.")
-                 details = data.get("details", "")
-                 progress_bar_placeholder.empty() # Remove progress bar on error
-                 status_text_placeholder.error(f"Status: An error occurred!")
-                 result_placeholder.error(f"**Error:** {error_msg}\nDetails: {details}")
-                 st.write("Stream stopped due to error.")
-                 break # Exit the loop on error
-
-            # --- Handle any other message types (optional) ---
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def render_live_job():
+    """Redraws only this part of the page on a timer while the reader is running."""
+    reader = st.session_state["reader"]
+    state = reader.snapshot()
+    render_job_state(state)
+    if state["stopped"]:
+        # Redraw the whole page once more, without the timer
+        st.rerun()
+    # Stops the job on the backend, not just our stream; the stream then ends with a 'cancelled' event
+    if st.button("Cancel Job", key="cancel_task"):
+        try:
+            cancel_job(reader.job_id)
+        except httpx.HTTPError as e:
+            st.error(f"❌ **Request Error:** Could not cancel the job.\nDetails: {e}")
+
+
+def start_job():
+    """Asks the backend to start a new job and returns its id."""
+    # share=false: a new run that is this session's own, so cancelling it stops nobody
+    # else's (the backend refuses to cancel shared jobs), and nothing else attaches to it
+    response = http_client().post(f"{FASTAPI_BACKEND_URL}/jobs", params={"share": "false"},
+                                  headers=session_headers())
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    # Every job started in this session is offered on the dashboard
+    known = st.session_state.setdefault("job_ids", [])
+    if job_id not in known:
+        known.append(job_id)
+    return job_id
+
+
+def cancel_job(job_id):
+    """Asks the backend to cancel a running job."""
+    response = http_client().delete(f"{FASTAPI_BACKEND_URL}/jobs/{job_id}", headers=session_headers())
+    if response.status_code != 409: # 409: it already finished (our jobs are never shared)
+        response.raise_for_status()
+
+
+def single_job_view():
+    # --- Button to start the process ---
+    if st.button("Start Task and Monitor Progress", key="start_task"):
+        try:
+            st.session_state["job_id"] = start_job()
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in (429, 503):
+                raise
+            # Admission control: too many jobs right now, for us or for the server
+            retry_after = e.response.headers.get("Retry-After", "a few")
+            st.warning(f"⏳ The backend is busy ({e.response.json().get('detail')}). "
+                       f"Please try again in {retry_after} seconds.")
+        except httpx.HTTPError as e:
+            st.error(
+                f"❌ **Connection Error:** Failed to start a job on the backend at `{FASTAPI_BACKEND_URL}`.\n"
+                f"Please ensure the FastAPI server (`main_progress.py`) is running.\n"
+                f"Details: {e}"
+            )
+        else:
+            watch_job(st.session_state["job_id"])
+
+    reader = st.session_state.get("reader")
+    if reader is None:
+        st.info("Click the button above to start the task and see live progress updates.")
+        return
+    state = reader.snapshot()
+    if not state["stopped"]:
+        render_live_job()
+        return
+    render_job_state(state)
+    if state["result"] is not None and not st.session_state.get("celebrated"):
+        st.session_state["celebrated"] = True
+        st.balloons() # Fun celebration!
+    # --- Reattach to a job that is still running (e.g. after a lost connection) ---
+    if not state["finished"]:
+        job_id = reader.job_id
+        st.info(f"Job `{job_id}` may still be running on the backend. Click below to resume monitoring it.")
+        if st.button(f"Resume Monitoring Job {job_id[:8]}", key="resume_task"):
+            watch_job(job_id, resume=True)
+            st.rerun()
+
+
+# --- Dashboard: many jobs over a single connection ---
+DASHBOARD_COLUMNS = 3
+
+
+class MultiJobStreamReader(JobStreamReader):
+    """
+    Reads the multiplexed stream of several jobs (/stream-jobs) in one thread.
+    Events carry their job_id, and the state keeps the latest progress of each job.
+    """
+
+    def __init__(self, job_ids, client, last_event_id=None, headers=None):
+        self.job_ids = job_ids
+        super().__init__(job_ids[0], client, last_event_id, headers=headers)
+        self._state["jobs"] = {
+            job_id: {"progress": (0, "Waiting for connection..."), "status": "pending", "error": None}
+            for job_id in job_ids
+        }
+
+    def _stream_url(self):
+        return f"{FASTAPI_BACKEND_URL}/stream-jobs", {"job_id": self.job_ids}
+
+    def snapshot(self):
+        with self._lock:
+            state = {**self._state, "log": list(self._state["log"]), "connected": self._connected()}
+            state["jobs"] = {job_id: dict(job) for job_id, job in self._state["jobs"].items()}
+            return state
+
+    def _handle(self, event):
+        if not event.data:
+            return False
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError:
+            return False
+        with self._lock:
+            state = self._state
+            state["events_received"] += 1
+            if event.id:
+                state["last_event_id"] = event.id
+            jobs = state["jobs"]
+            if event.event == 'jobs':
+                for info in data.get("jobs", []):
+                    jobs[info["job_id"]]["status"] = info["status"]
+                for job_id in data.get("unknown", []):
+                    jobs[job_id].update(status="unknown", error="Unknown job (it may have expired).")
+            elif data.get("job_id") in jobs:
+                job = jobs[data["job_id"]]
+                if event.event == 'progress':
+                    percent = data.get("percent", 0)
+                    job["progress"] = (percent, data.get("message", "Processing..."))
+                    job["status"] = "running"
+                elif event.event == 'complete':
+                    job.update(progress=(100, data.get("result", "Task finished successfully!")), status="completed")
+                elif event.event == 'error':
+                    job.update(status="failed", error=data.get("error", "Unknown error occurred."))
+                elif event.event == 'cancelled':
+                    job.update(progress=(job["progress"][0], data.get("reason", "Cancelled.")), status="cancelled")
+            # The server ends the stream too, but there is no need to wait for it
+            state["finished"] = all(
+                job["status"] in ("completed", "failed", "cancelled", "unknown") for job in jobs.values()
+            )
+            return state["finished"]
+
+
+def render_dashboard_state(state):
+    """Draws a progress bar per job, in a grid."""
+    if state["error"] is not None:
+        st.error(state["error"])
+    columns = st.columns(DASHBOARD_COLUMNS)
+    for index, (job_id, job) in enumerate(state["jobs"].items()):
+        with columns[index % DASHBOARD_COLUMNS]:
+            st.markdown(f"**Job `{job_id[:8]}`** · {job['status']}")
+            if job["error"] is not None:
+                st.error(job["error"])
             else:
-                 # This might catch default 'message' events if the server sends them
-                 st.write(f"Received unhandled event type '{event.event}': {event.data}")
-
-
-        # Close the connection after the loop finishes or breaks
-        client.close()
-        response.close() # Ensure the requests response is also closed
-        st.write("Connection closed.")
-
-    except requests.exceptions.ConnectionError as e:
-        progress_bar_placeholder.empty()
-        status_text_placeholder.empty()
-        result_placeholder.error(
-            f"❌ **Connection Error:** Failed to connect to the backend at `{FASTAPI_BACKEND_URL}`.\n"
-            f"Please ensure the FastAPI server (`main_progress.py`) is running.\n"
-            f"Details: {e}"
-        )
-    except requests.exceptions.RequestException as e:
-        progress_bar_placeholder.empty()
-        status_text_placeholder.empty()
-        result_placeholder.error(
-            f"❌ **Request Error:** An error occurred during the request to the backend.\n"
-            f"Details: {e}"
-        )
-    except Exception as e:
-        # Catch any other unexpected errors during stream processing
-        progress_bar_placeholder.empty()
-        status_text_placeholder.empty()
-        result_placeholder.error(f"💥 **An unexpected error occurred:**\n{e}")
-        st.exception(e) # Show traceback in Streamlit for debugging
+                percent, message = job["progress"]
+                st.progress(percent / 100.0, text=message)
+    st.caption(f"{state['events_received']} events received over one connection.")
+
+
+@st.fragment(run_every=UI_REFRESH_SECONDS)
+def render_live_dashboard():
+    state = st.session_state["dashboard_reader"].snapshot()
+    render_dashboard_state(state)
+    if state["stopped"]:
+        st.rerun()
+
+
+def dashboard_view():
+    st.markdown("Follow several jobs at once. All of them share a single SSE connection (`/stream-jobs`).")
+    if st.button("Start Another Job", key="start_dashboard_job"):
+        try:
+            job_id = start_job()
+        except httpx.HTTPError as e:
+            st.error(f"❌ **Connection Error:** Failed to start a job on the backend.\nDetails: {e}")
+        else:
+            # The text area keeps its own value once shown, so the new id goes into its state
+            text = st.session_state.get("dashboard_job_ids", "").rstrip()
+            if "dashboard_job_ids" in st.session_state and job_id not in text.split():
+                st.session_state["dashboard_job_ids"] = f"{text}\n{job_id}" if text else job_id
+    # At first, the jobs started in this session
+    st.session_state.setdefault("dashboard_job_ids", "\n".join(st.session_state.get("job_ids", [])))
+    job_ids_text = st.text_area("Job ids (one per line)", key="dashboard_job_ids")
+    job_ids = list(dict.fromkeys(line.strip() for line in job_ids_text.splitlines() if line.strip()))
+    if st.button("Watch These Jobs", key="watch_jobs", disabled=not job_ids):
+        previous = st.session_state.get("dashboard_reader")
+        if previous is not None:
+            previous.stop()
+        st.session_state["dashboard_reader"] = MultiJobStreamReader(job_ids, http_client(), headers=session_headers()).start()
+
+    reader = st.session_state.get("dashboard_reader")
+    if reader is None:
+        st.info("Start a job or paste job ids, then click 'Watch These Jobs'.")
+    elif not reader.snapshot()["stopped"]:
+        render_live_dashboard()
+    else:
+        render_dashboard_state(reader.snapshot())
+
 
+view = st.sidebar.radio("View", ["Single job", "Job dashboard"], key="view")
+if view == "Single job":
+    single_job_view()
 else:
-    st.info("Click the button above to start the task and see live progress updates.")
+    dashboard_view()
 
 st.markdown("---")
 st.markdown("*(App will wait for events after connection. If the backend task finishes quickly, you might see the final state directly.)*")
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Optional
+
+from executors import ExecutorKind, StepExecutors
+from metrics import STEP_DURATION
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    One step of a task graph.
+    `func` is called with the results of the steps it depends on, as keyword
+    arguments named after those steps. `cost` is the expected relative cost
+    of the step (e.g. its usual duration) and weights the reported progress.
+    `executor` says where it runs: an async function on the event loop, or
+    a plain function in a thread or process pool (see executors.py).
+    If `func` has a `reporter` parameter, it gets a ProgressReporter to report
+    how far along it is with `reporter.update(done, total)`.
+    """
+    name: str
+    func: Callable[..., Any]
+    depends_on: tuple[str, ...] = ()
+    cost: float = 1.0
+    executor: ExecutorKind = ExecutorKind.ASYNC
+
+    def __post_init__(self):
+        # Accept plain strings such as "process" as well
+        object.__setattr__(self, "executor", ExecutorKind(self.executor))
+
+
+class TaskGraph:
+    """A set of steps and their dependencies, checked for unknown steps and cycles."""
+
+    def __init__(self, steps: Iterable[Step]):
+        self.steps: dict[str, Step] = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step name: {step.name}")
+            if step.cost < 0:
+                raise ValueError(f"Step {step.name} has a negative cost")
+            self.steps[step.name] = step
+        for step in self.steps.values():
+            unknown = [dep for dep in step.depends_on if dep not in self.steps]
+            if unknown:
+                raise ValueError(f"Step {step.name} depends on unknown steps: {unknown}")
+        self.order = self._topological_order()
+
+    @property
+    def total_cost(self) -> float:
+        return sum(step.cost for step in self.steps.values())
+
+    def _topological_order(self) -> list[str]:
+        remaining = {name: set(step.depends_on) for name, step in self.steps.items()}
+        order = []
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Task graph has a cycle between: {sorted(remaining)}")
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+
+async def run_graph(
+    graph: TaskGraph,
+    on_step_done: Optional[Callable[[Step, Any, int], None]] = None,
+    max_concurrency: int = 4,
+    executors: Optional[StepExecutors] = None,
+    on_step_progress: Optional[Callable[[Step, int, int, int], None]] = None,
+) -> dict[str, Any]:
+    """
+    Runs the steps of the graph, starting each one as soon as its dependencies
+    are done, with at most `max_concurrency` steps at a time.
+    `on_step_done(step, result, percent)` is called as each step finishes, where
+    `percent` is the share of the total expected cost that is done so far.
+    `on_step_progress(step, done, total, percent)` is called when a running step
+    reports progress of its own.
+    Steps that run in a thread or process pool need `executors`.
+    Returns the result of every step. If a step fails, the running steps are
+    cancelled and the exception is raised.
+    """
+    if executors is None and any(step.executor != ExecutorKind.ASYNC for step in graph.steps.values()):
+        raise ValueError("Steps with a thread or process executor need a StepExecutors instance")
+    executors = executors or StepExecutors()
+
+    results: dict[str, Any] = {}
+    running: dict[asyncio.Task, Step] = {}
+    waiting = list(graph.order)
+    weights = {name: (step.cost if graph.total_cost else 1) for name, step in graph.steps.items()}
+    total_cost = sum(weights.values()) or 1
+    done_cost = 0.0
+    # How far along each running step says it is (0.0 to 1.0)
+    step_fractions: dict[str, float] = {}
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    def current_percent() -> int:
+        partial = sum(weights[name] * fraction for name, fraction in step_fractions.items())
+        return int((done_cost + partial) / total_cost * 100)
+
+    def progress_of(step: Step):
+        def report(done, total):
+            # Updates from a worker can arrive after the step already finished
+            if step.name not in step_fractions or total <= 0:
+                return
+            step_fractions[step.name] = min(max(done / total, 0.0), 1.0)
+            if on_step_progress is not None:
+                on_step_progress(step, done, total, current_percent())
+        return report
+
+    async def run_step(step: Step):
+        async with semaphore:
+            logger.debug(f"Running step {step.name} ({step.executor.value})")
+            step_fractions[step.name] = 0.0
+            kwargs = {dep: results[dep] for dep in step.depends_on}
+            started = time.perf_counter()
+            result = await executors.run(step.executor, step.func, kwargs, progress_of(step))
+            STEP_DURATION.labels(step.name).observe(time.perf_counter() - started)
+            return result
+
+    try:
+        while waiting or running:
+            # Start every step whose dependencies have all finished
+            for name in list(waiting):
+                step = graph.steps[name]
+                if all(dep in results for dep in step.depends_on):
+                    waiting.remove(name)
+                    running[asyncio.create_task(run_step(step))] = step
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                step = running.pop(task)
+                results[step.name] = task.result() # Raises if the step failed
+                step_fractions.pop(step.name, None)
+                done_cost += weights[step.name]
+                if on_step_done is not None:
+                    on_step_done(step, results[step.name], current_percent())
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    return {name: results[name] for name in graph.order}